@@ -0,0 +1,25 @@
+import os
+import tempfile
+
+
+def configure(database_url: str | None = None, **environ: str) -> str:
+    """Point the settings at a scratch database and data directory
+    before `src` loads, return the temporary directory holding them.
+
+    `environ` holds further variables, set unless the environment has
+    them already.
+    """
+    tmp = tempfile.mkdtemp(prefix='memo-')
+    os.environ['DATABASE_URL'] = database_url or f'sqlite:///{tmp}/memo.db'
+    os.environ['DATA_DIR'] = f'{tmp}/data'
+    defaults = {
+        'LOG_PATH': f'{tmp}/memo.log',
+        'SECRET_KEY': 'scratch',
+        'ALGORITHM': 'HS256',
+        'ACCESS_TOKEN_EXPIRE_DAYS': '1',
+        'STAGE': 'test',
+        **environ,
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    return tmp
@@ -0,0 +1,78 @@
+"""Compare `response_model` serialization with `FastJSONResponse`.
+
+The `response_model` path is what FastAPI does for a route declared
+with `response_model=list[schemas.Item]`: validate every item and image
+through the pydantic models, `jsonable_encoder`, then `json.dumps`. The
+fast path builds plain dicts with `item_dict` and encodes them once.
+
+Run from `server/`:
+
+    python -m benchmarks.bench_serialize --items 100 --images 4
+"""
+import argparse
+import asyncio
+import timeit
+
+from benchmarks import configure
+
+configure()
+
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+
+from src import responses, schemas  # noqa: E402
+from src.database import Image, Item  # noqa: E402
+from src.routers.item import item_dict, parse_images  # noqa: E402
+
+
+def make_items(n_items: int, n_images: int) -> list[Item]:
+    items = []
+    for i in range(n_items):
+        item = Item(id=i,
+                    text=f'memo {i} ' * 20,
+                    owner_id=1,
+                    created_time=1660000000000 + i,
+                    updated_time=1660000000000 + i)
+        item.images = [
+            Image(id=i * n_images + j, data=f'blobs/{j}.jpg', item_id=i)
+            for j in range(n_images)
+        ]
+        items.append(item)
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--images', type=int, default=4)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    items = make_items(args.items, args.images)
+    field = create_response_field(name='bench', type_=list[schemas.Item])
+    loop = asyncio.new_event_loop()
+
+    def response_model() -> bytes:
+        for item in items:
+            item.images = parse_images(item.images)
+        content = loop.run_until_complete(
+            serialize_response(field=field, response_content=items))
+        return JSONResponse(content).body
+
+    def fast() -> bytes:
+        return responses.FastJSONResponse([item_dict(i) for i in items]).body
+
+    encoder = 'orjson' if responses.orjson is not None else 'json'
+    print(f'{args.items} items with {args.images} images, '
+          f'{len(fast())} bytes, fast path encoder: {encoder}')
+    results = {}
+    for name, func in (('response_model', response_model), ('fast', fast)):
+        seconds = min(timeit.repeat(func, number=args.number, repeat=3))
+        results[name] = seconds / args.number
+        print(f'{name:<15} {results[name] * 1000:8.3f} ms per page')
+    print(f'speedup {results["response_model"] / results["fast"]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
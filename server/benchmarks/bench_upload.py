@@ -0,0 +1,150 @@
+"""Compare the spooled and the streaming upload paths.
+
+Both paths store files with `upload.BlobWriter`. The spooled path, which
+the app used before `upload.receive_form`, lets Starlette buffer the
+body into `UploadFile`s first, which spill to a temporary file past
+1 MB, then copies up to `--concurrency` of them at a time. The
+streaming path writes parts to disk as they arrive.
+
+Run from `server/`:
+
+    python -m benchmarks.bench_upload --files 4 --size-mb 8 --rounds 10
+
+Disk writes are read from `/proc/self/io` (Linux only).
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from contextlib import asynccontextmanager
+
+from benchmarks import configure
+
+configure(MAX_FILE_SIZE=str(1024 * 1024 * 1024),
+          MAX_UPLOAD_SIZE=str(1024 * 1024 * 1024))
+
+from fastapi import FastAPI, Request, UploadFile  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from src import crud, upload  # noqa: E402
+from src.database import AsyncSessionLocal, Base, engine  # noqa: E402
+
+CHUNK_SIZE = 1024 * 1024 * 5  # 5 MB
+concurrency = 4
+app = FastAPI()
+
+
+async def save_file(file: UploadFile,
+                    budget: upload.UploadBudget) -> upload.StoredFile:
+    """Copy a spooled `UploadFile` into `DATA_DIR`."""
+    writer = upload.BlobWriter(file.filename, file.content_type, budget)
+    try:
+        while chunk := await file.read(CHUNK_SIZE):
+            await writer.write(chunk)
+        # The copies run at the same time, a session can't be shared
+        async with AsyncSessionLocal() as db:
+            return await writer.close(db)
+    except BaseException:
+        await writer.abort()
+        raise
+
+
+@asynccontextmanager
+async def saved_files(db, files: list[UploadFile]):
+    """Save `UploadFile`s, `concurrency` at a time, and yield them as
+    `StoredFile`s. Their references are released at the end, removing
+    files nothing else references."""
+    stored: list[upload.StoredFile] = []
+    semaphore = asyncio.Semaphore(concurrency)
+    budget = upload.UploadBudget(upload.MAX_UPLOAD_SIZE)
+
+    async def save(file: UploadFile) -> upload.StoredFile:
+        async with semaphore:
+            stored_file = await save_file(file, budget)
+        stored.append(stored_file)
+        return stored_file
+
+    tasks = [asyncio.create_task(save(file)) for file in files]
+    try:
+        yield list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await db.rollback()
+        raise
+    finally:
+        await upload.release_stored(db, stored)
+
+
+@app.post('/spooled')
+async def spooled(request: Request):
+    form = await request.form()
+    async with AsyncSessionLocal() as db:
+        async with saved_files(db, form.getlist('images')) as stored:
+            await crud.acquire_blobs(db, [f.name for f in stored])
+            await db.commit()
+    await form.close()
+    return len(stored)
+
+
+@app.post('/streaming')
+async def streaming(request: Request):
+    async with AsyncSessionLocal() as db:
+        async with upload.receive_form(request, db) as form:
+            stored = form.get_files('images')
+            await crud.acquire_blobs(db, [f.name for f in stored])
+            await db.commit()
+    return len(stored)
+
+
+def disk_writes() -> tuple[int, int]:
+    """Bytes passed to write() and bytes sent to the block layer."""
+    with open('/proc/self/io') as f:
+        io = dict(line.split(': ') for line in f.read().splitlines())
+    return int(io['wchar']), int(io['write_bytes'])
+
+
+def run(client: TestClient, path: str, files: int, size: int, rounds: int):
+    latencies = []
+    wchar = write_bytes = 0
+    for _ in range(rounds):
+        # Fresh content, so every round stores new blobs
+        body = [('images', (f'{i}.jpg', os.urandom(size), 'image/jpeg'))
+                for i in range(files)]
+        before = disk_writes()
+        start = time.perf_counter()
+        r = client.post(path, files=body)
+        latencies.append(time.perf_counter() - start)
+        after = disk_writes()
+        assert r.status_code == 200, r.text
+        wchar += after[0] - before[0]
+        write_bytes += after[1] - before[1]
+    payload = files * size * rounds
+    print(f'{path:<12}'
+          f' p50 {statistics.median(latencies) * 1000:8.1f} ms'
+          f'  max {max(latencies) * 1000:8.1f} ms'
+          f'  written {wchar / payload:5.2f}x payload'
+          f'  (block layer {write_bytes / payload:5.2f}x)')
+
+
+def main():
+    global concurrency
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--size-mb', type=float, default=8)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=concurrency)
+    args = parser.parse_args()
+    concurrency = args.concurrency
+    Base.metadata.create_all(bind=engine)
+    size = int(args.size_mb * 1024 * 1024)
+    print(f'{args.files} files of {args.size_mb} MB, {args.rounds} rounds')
+    with TestClient(app) as client:
+        for path in ('/spooled', '/streaming'):
+            run(client, path, args.files, size, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,405 @@
+"""Load test of the API hot paths, in-process.
+
+Boots `src.main:app` against a throwaway database (a temporary SQLite
+file unless `--database-url` is given, e.g. a scratch Postgres), seeds
+users, items and images through the API, then drives each scenario with
+`--concurrency` concurrent clients. Requests go straight to the ASGI
+app, so the numbers are the app's own cost without any network.
+
+For every scenario it reports p50/p95/p99 latency, throughput and SQL
+statements per request. `--save-baseline` writes them to a JSON file,
+later runs compare against it and exit with 1 on a regression:
+
+    python -m benchmarks.load --save-baseline benchmarks/baseline.json
+    python -m benchmarks.load --baseline benchmarks/baseline.json
+
+Run from `server/`. bcrypt uses 4 rounds unless `BCRYPT_ROUNDS` is set,
+so seeding stays fast; login numbers scale with the real setting.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from benchmarks import configure
+
+SCENARIOS = ('login', 'list', 'recycle', 'create', 'edit', 'delete', 'restore',
+             'data', 'thumbnail')
+
+
+def make_jpeg(size: tuple[int, int]) -> bytes:
+    from PIL import Image
+    image = Image.effect_noise(size, random.uniform(20, 80)).convert('RGB')
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=85)
+    return out.getvalue()
+
+
+class Client:
+    """Calls an ASGI app directly and times each response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self,
+                      method: str,
+                      url: str,
+                      token: str | None = None,
+                      **kwargs) -> tuple[int, bytes, float]:
+        """Returns the status, body and seconds until the last byte.
+
+        `kwargs` are those of `requests.Request`, which encodes forms
+        and multipart bodies.
+        """
+        headers = kwargs.pop('headers', {})
+        if token is not None:
+            headers['Authorization'] = f'Bearer {token}'
+        prepared = requests.Request(method,
+                                    f'http://testserver{url}',
+                                    headers=headers,
+                                    **kwargs).prepare()
+        body = prepared.body or b''
+        if isinstance(body, str):
+            body = body.encode()
+        parts = urlsplit(prepared.url)
+        scope = {
+            'type':
+            'http',
+            'asgi': {
+                'version': '3.0'
+            },
+            'http_version':
+            '1.1',
+            'method':
+            method,
+            'scheme':
+            'http',
+            'path':
+            parts.path,
+            'raw_path':
+            parts.path.encode(),
+            'query_string':
+            parts.query.encode(),
+            'root_path':
+            '',
+            'headers': [(k.lower().encode(), v.encode())
+                        for k, v in prepared.headers.items()],
+            'client': ('127.0.0.1', 50000),
+            'server': ('testserver', 80),
+        }
+        done = asyncio.Event()
+        sent = False
+        status = 0
+        chunks: list[bytes] = []
+        elapsed = 0.0
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': 'http.request', 'body': body}
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status, elapsed
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body', False):
+                    elapsed = time.perf_counter() - start
+                    done.set()
+
+        start = time.perf_counter()
+        await self.app(scope, receive, send)
+        return status, b''.join(chunks), elapsed
+
+
+class QueryCounter:
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+class State:
+    """Seeded users, with the ids the scenarios work on."""
+
+    def __init__(self):
+        self.users: list[dict] = []
+        self.jpegs: list[bytes] = []
+
+    def user(self, i: int) -> dict:
+        return self.users[i % len(self.users)]
+
+
+async def seed(client: Client, args, state: State):
+    state.jpegs = [make_jpeg(args.image_size) for _ in range(16)]
+    password = 'password12Caps@#$'
+    for n in range(args.users):
+        name = f'load_{n}_{os.urandom(3).hex()}'
+        status, body, _ = await client.request('POST',
+                                               '/api/v1/auth/register',
+                                               json={
+                                                   'name': name,
+                                                   'password': password
+                                               })
+        assert status == 200, body
+        status, body, _ = await client.request('POST',
+                                               '/api/v1/auth/login',
+                                               data={
+                                                   'username': name,
+                                                   'password': password
+                                               })
+        assert status == 200, body
+        state.users.append({
+            'name': name,
+            'password': password,
+            'token': json.loads(body)['access_token'],
+            'items': [],
+            'images': [],
+            'deleted': [],
+        })
+
+    async def create(i: int):
+        user = state.user(i)
+        status, body, _ = await client.request(
+            'POST',
+            '/api/v1/item/',
+            user['token'],
+            data={'text': f'memo {i} ' * 10},
+            files=upload_files(state, args.images, i))
+        assert status == 200, body
+        item = json.loads(body)
+        user['items'].append(item['id'])
+        user['images'] += [img['id'] for img in item['images']]
+
+    await gather_limited([create(i) for i in range(args.users * args.items)],
+                         args.concurrency)
+
+
+def upload_files(state: State, n: int, i: int) -> list:
+    # A random tail keeps every upload unique, as real photos are
+    return [('images',
+             (f'{i}-{j}.jpg',
+              state.jpegs[(i + j) % len(state.jpegs)] + os.urandom(16),
+              'image/jpeg')) for j in range(n)]
+
+
+async def gather_limited(coros: list, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(c) for c in coros))
+
+
+def scenario_request(name: str, i: int, state: State, args) -> tuple:
+    """`(method, url, token, kwargs)` of the `i`th request of a
+    scenario."""
+    user = state.user(i)
+    token = user['token']
+    n = i // len(state.users)
+    if name == 'login':
+        return 'POST', '/api/v1/auth/login', None, {
+            'data': {
+                'username': user['name'],
+                'password': user['password']
+            }
+        }
+    if name == 'list':
+        return 'GET', '/api/v1/item/list', token, {}
+    if name == 'recycle':
+        return 'GET', '/api/v1/item/recycle', token, {}
+    if name == 'create':
+        return 'POST', '/api/v1/item/', token, {
+            'data': {
+                'text': f'new memo {i}'
+            },
+            'files': upload_files(state, args.images, i)
+        }
+    if name == 'edit':
+        item_id = user['items'][n % len(user['items'])]
+        return 'PUT', f'/api/v1/item/{item_id}', token, {
+            'data': {
+                'text': f'edited {i}'
+            },
+            'files':
+            [('add',
+              ('edit.jpg', state.jpegs[i % len(state.jpegs)] + os.urandom(16),
+               'image/jpeg'))]
+        }
+    if name == 'delete':
+        item_id = user['items'][n % len(user['items'])]
+        user['deleted'].append(item_id)
+        return 'DELETE', f'/api/v1/item/{item_id}', token, {}
+    if name == 'restore':
+        item_id = user['deleted'][n % len(user['deleted'])]
+        return 'POST', f'/api/v1/item/restore/{item_id}', token, {}
+    image_id = user['images'][n % len(user['images'])]
+    if name == 'thumbnail':
+        return 'GET', f'/data/{image_id}?size=thumb', None, {}
+    return 'GET', f'/data/{image_id}', None, {}
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    index = min(
+        len(sorted_values) - 1, int(round(p * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run_scenario(client: Client, counter: QueryCounter, name: str,
+                       state: State, args) -> dict:
+    # Deletes and restores touch each item once per pass
+    n_requests = args.requests
+    if name in ('delete', 'restore'):
+        n_requests = min(n_requests, args.users * args.items)
+    latencies: list[float] = []
+    errors = 0
+    requests_ = [
+        scenario_request(name, i, state, args) for i in range(n_requests)
+    ]
+
+    async def one(method, url, token, kwargs):
+        nonlocal errors
+        status, _, elapsed = await client.request(method, url, token, **kwargs)
+        if status >= 400:
+            errors += 1
+        latencies.append(elapsed)
+
+    queries = counter.count
+    start = time.perf_counter()
+    await gather_limited([one(*r) for r in requests_], args.concurrency)
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': n_requests,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'throughput_rps': round(n_requests / wall, 1),
+        'queries_per_request': round((counter.count - queries) / n_requests,
+                                     2),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Regressions of `results` against `baseline`.
+
+    Latency may grow by `tolerance` (0.5 is 50%) before it counts, since
+    it depends on the machine. Query counts and errors must not grow.
+    """
+    problems = []
+    for name, base in baseline['scenarios'].items():
+        result = results['scenarios'].get(name)
+        if result is None:
+            continue
+        if result['errors'] > base['errors']:
+            problems.append(f"{name}: {result['errors']} errors, "
+                            f"baseline {base['errors']}")
+        if result['queries_per_request'] > base['queries_per_request'] + 0.01:
+            problems.append(
+                f"{name}: {result['queries_per_request']} queries per "
+                f"request, baseline {base['queries_per_request']}")
+        for key in ('p50_ms', 'p95_ms'):
+            if result[key] > base[key] * (1 + tolerance):
+                problems.append(f"{name}: {key} {result[key]}, "
+                                f"baseline {base[key]}")
+    return problems
+
+
+async def main_async(args) -> dict:
+    from src.database import async_engine
+    from src.main import app
+
+    client = Client(app)
+    counter = QueryCounter(async_engine.sync_engine)
+    state = State()
+    start = time.perf_counter()
+    await seed(client, args, state)
+    print(f'seeded {args.users} users x {args.items} items x '
+          f'{args.images} images in {time.perf_counter() - start:.1f} s')
+    results = {
+        'config': {
+            'users': args.users,
+            'items': args.items,
+            'images': args.images,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'database': async_engine.dialect.name,
+        },
+        'scenarios': {},
+    }
+    print(f'{"scenario":<10} {"reqs":>5} {"err":>4} {"p50 ms":>9} '
+          f'{"p95 ms":>9} {"p99 ms":>9} {"req/s":>8} {"queries":>8}')
+    for name in args.scenarios:
+        r = await run_scenario(client, counter, name, state, args)
+        results['scenarios'][name] = r
+        print(f'{name:<10} {r["requests"]:>5} {r["errors"]:>4} '
+              f'{r["p50_ms"]:>9.2f} {r["p95_ms"]:>9.2f} {r["p99_ms"]:>9.2f} '
+              f'{r["throughput_rps"]:>8.1f} {r["queries_per_request"]:>8.2f}')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', help='defaults to a temp SQLite')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--items', type=int, default=20)
+    parser.add_argument('--images', type=int, default=2)
+    parser.add_argument('--image-size',
+                        type=lambda s: tuple(map(int, s.split('x'))),
+                        default=(640, 480))
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--scenarios',
+                        type=lambda s: s.split(','),
+                        default=list(SCENARIOS))
+    parser.add_argument('--baseline', help='fail on regressions against it')
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--save-baseline', help='write the results here')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    configure(args.database_url,
+              BCRYPT_ROUNDS='4',
+              PURGE_INTERVAL='0',
+              LOGIN_RATE_LIMIT='0/1',
+              REGISTER_RATE_LIMIT='0/1',
+              UPLOAD_RATE_LIMIT='0/1')
+    results = asyncio.run(main_async(args))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'baseline written to {args.save_baseline}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f'REGRESSION {problem}')
+        if problems:
+            sys.exit(1)
+        print('no regressions')
+
+
+if __name__ == '__main__':
+    main()
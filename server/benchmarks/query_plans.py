@@ -0,0 +1,220 @@
+"""Query plans of the hot queries before and after the migrations.
+
+Creates the tables of the last release, which have no indexes but the
+primary keys and `users.name`, in a scratch database (a temporary
+SQLite file unless `--database-url` points at an empty Postgres). Seeds
+them with millions of rows and prints the plan and median time of every
+hot query. Then it runs `src.migrate` and does the same again. Exits
+with 1 if a query still scans a whole table after the migrations.
+
+Run from `server/`:
+
+    python -m benchmarks.query_plans --users 2000 --items 500 --images 2
+"""
+import argparse
+import random
+import re
+import statistics
+import sys
+import time
+
+from benchmarks import configure
+
+FULL_SCAN = re.compile(
+    r"^\W*(SCAN (items|images|user_statistics)\b(?! USING)"
+    r"|Seq Scan on (items|images|user_statistics)\b)", re.MULTILINE)
+START_TIME = 1_600_000_000_000
+CHUNK = 20_000
+
+
+def seed(engine, args):
+    """Users with `args.items` items of `args.images` images each. A
+    tenth of the items are in the recycle bin, some images were removed
+    by edits."""
+    from sqlalchemy import insert
+
+    from src.database import Image, Item, User, UserStatistics
+
+    rng = random.Random(0)
+    item_id = image_id = 0
+    items: list[dict] = []
+    images: list[dict] = []
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{
+            'id': u,
+            'name': f'user_{u}',
+            'created_time': START_TIME
+        } for u in range(1, args.users + 1)])
+        conn.execute(insert(UserStatistics), [{
+            'user_id': u,
+            'total_items': 0,
+            'total_images': 0
+        } for u in range(1, args.users + 1)])
+        for _ in range(args.items):
+            for user_id in range(1, args.users + 1):
+                item_id += 1
+                created = START_TIME + item_id * 1000
+                deleted = created + 5000 if rng.random() < 0.1 else None
+                items.append({
+                    'id': item_id,
+                    'text': f'memo {item_id}',
+                    'owner_id': user_id,
+                    'created_time': created,
+                    'updated_time': deleted or created,
+                    'deleted_at': deleted,
+                })
+                for _ in range(args.images):
+                    image_id += 1
+                    removed = None
+                    if deleted is None and rng.random() < 0.05:
+                        removed = created + 1000
+                    images.append({
+                        'id': image_id,
+                        'data': f'blobs/{image_id:012x}.jpg',
+                        'item_id': item_id,
+                        'owner_id': user_id,
+                        'created_at': created,
+                        'deleted_at': deleted or removed,
+                    })
+                if len(images) >= CHUNK or len(items) >= CHUNK:
+                    conn.execute(insert(Item), items)
+                    if images:
+                        conn.execute(insert(Image), images)
+                    items, images = [], []
+        if items:
+            conn.execute(insert(Item), items)
+        if images:
+            conn.execute(insert(Image), images)
+    return item_id, image_id
+
+
+def hot_queries(user_id: int, n_items: int, n_images: int) -> dict:
+    """The statements of the hot endpoints, as `crud` builds them."""
+    from sqlalchemy import select, tuple_
+
+    from src import crud
+    from src.database import Image, Item, UserStatistics
+
+    live = (Item.owner_id == user_id, Item.deleted_at == None)
+    newest = (Item.created_time.desc(), Item.id.desc())
+    cursor = tuple_(START_TIME + n_items * 500, n_items // 2)
+    page_ids = list(range(n_items // 2, n_items // 2 + 10))
+    deleted = (Item.owner_id == user_id, Item.deleted_at != None)
+    before = START_TIME + n_items * 500
+    return {
+        'list':
+        select(Item).where(*live).order_by(*newest).limit(10),
+        'list cursor':
+        select(Item).where(
+            *live,
+            tuple_(Item.created_time, Item.id) < cursor).order_by(
+                *newest).limit(10),
+        'page images':
+        select(Image).where(Image.item_id.in_(page_ids),
+                            Image.deleted_at == None).order_by(Image.id),
+        'recycle':
+        select(Item).where(*deleted).order_by(Item.deleted_at.desc(),
+                                              Item.id.desc()).limit(10),
+        'changes':
+        select(Item).where(Item.owner_id == user_id,
+                           Item.updated_time > before).order_by(
+                               Item.updated_time, Item.id).limit(100),
+        'image by path':
+        select(Image).where(Image.data == f'blobs/{n_images // 2:012x}.jpg'),
+        'image paths':
+        select(Image.data).join(Item).where(
+            Image.owner_id == user_id, Image.deleted_at == None,
+            Item.deleted_at == None).distinct().order_by(Image.data),
+        'user statistics':
+        select(UserStatistics).where(UserStatistics.user_id == user_id),
+        'recount statistics':
+        crud.recount_user_statistics([user_id]),
+        'expired items':
+        select(Item.id).where(Item.deleted_at != None,
+                              Item.deleted_at < before).order_by(
+                                  Item.deleted_at).limit(500),
+        'expired images':
+        select(Image.id).where(Image.deleted_at != None,
+                               Image.deleted_at < before).order_by(
+                                   Image.deleted_at).limit(500),
+    }
+
+
+def explain(conn, sql: str) -> str:
+    prefix = ('EXPLAIN QUERY PLAN '
+              if conn.dialect.name == 'sqlite' else 'EXPLAIN ')
+    rows = conn.exec_driver_sql(prefix + sql).all()
+    if conn.dialect.name == 'sqlite':
+        # id, parent, notused, detail
+        return '\n'.join(row[-1] for row in rows)
+    return '\n'.join(row[0] for row in rows)
+
+
+def measure(engine, queries: dict, repeat: int) -> dict:
+    results = {}
+    with engine.connect() as conn:
+        conn.exec_driver_sql('ANALYZE')
+        for name, stmt in queries.items():
+            sql = str(
+                stmt.compile(dialect=engine.dialect,
+                             compile_kwargs={'literal_binds': True}))
+            plan = explain(conn, sql)
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                with conn.begin():
+                    result = conn.exec_driver_sql(sql)
+                    if result.returns_rows:
+                        result.all()
+                times.append(time.perf_counter() - start)
+            results[name] = (plan, statistics.median(times) * 1000)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', help='defaults to a temp SQLite')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--items', type=int, default=500)
+    parser.add_argument('--images', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    configure(args.database_url)
+
+    from sqlalchemy import inspect
+
+    from src import migrate
+    from src.database import engine
+
+    if inspect(engine).get_table_names():
+        sys.exit('the database is not empty')
+    with engine.begin() as conn:
+        migrate.create_released_tables(conn)
+
+    start = time.perf_counter()
+    n_items, n_images = seed(engine, args)
+    print(f'seeded {args.users} users, {n_items} items, {n_images} images '
+          f'in {time.perf_counter() - start:.1f} s')
+    queries = hot_queries(args.users // 2, n_items, n_images)
+    before = measure(engine, queries, args.repeat)
+
+    start = time.perf_counter()
+    migrate.upgrade(engine)
+    print(f'migrated in {time.perf_counter() - start:.1f} s')
+    after = measure(engine, queries, args.repeat)
+
+    scans = []
+    for name in queries:
+        (old_plan, old_ms), (new_plan, new_ms) = before[name], after[name]
+        print(f'\n== {name}: {old_ms:.3f} ms -> {new_ms:.3f} ms')
+        print(f'before:\n{old_plan}\nafter:\n{new_plan}')
+        if FULL_SCAN.search(new_plan):
+            scans.append(name)
+    if scans:
+        print(f'\nFULL SCAN after migrations: {", ".join(scans)}')
+        sys.exit(1)
+    print('\nno full table scans after migrations')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+import redis
+from redis import asyncio as aioredis
+
+from src import schemas
+from src.config import get_settings
+
+USER_CACHE_TTL = 60  # seconds
+USER_CACHE_SIZE = 1024
+USER_KEY_PREFIX = "user:"
+IMAGE_CACHE_TTL = 60 * 60  # seconds
+IMAGE_CACHE_SIZE = 4096
+LIST_CACHE_TTL = 5 * 60  # seconds
+LIST_CACHE_SIZE = 4096
+LIST_VERSION_PREFIX = "items:version:"
+LIST_PAGE_PREFIX = "items:page:"
+# Workers can't bump each other's in-memory versions, so with several
+# only Redis caches list pages
+LOCAL_LIST_CACHE = int(get_settings().web_concurrency) <= 1
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class CacheStats:
+    """Hits and misses of a cache, for tuning its size and TTL."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# image id -> (stored name, file type, created_at)
+image_cache = TTLCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_TTL)
+# (user id, version, page) -> serialized page, when Redis is unavailable
+list_cache = TTLCache(LIST_CACHE_SIZE, LIST_CACHE_TTL)
+list_versions: dict[int, int] = {}
+# Users whose Redis version could not be bumped, bumped once Redis
+# answers again so its pages from before the outage are not served
+missed_bumps: set[int] = set()
+list_stats = CacheStats()
+
+
+async def get_cached_user(
+        name: str,
+        redis_client: aioredis.Redis | None = None
+) -> schemas.CurrentUser | None:
+    """Look up an authenticated user in memory, then in Redis."""
+    user = user_cache.get(name)
+    if user is not None or redis_client is None:
+        return user
+    try:
+        raw = await redis_client.get(USER_KEY_PREFIX + name)
+    except redis.RedisError:
+        return None
+    if raw is None:
+        return None
+    user = schemas.CurrentUser.parse_raw(raw)
+    user_cache.set(name, user)
+    return user
+
+
+async def set_cached_user(user: schemas.CurrentUser,
+                          redis_client: aioredis.Redis | None = None):
+    user_cache.set(user.name, user)
+    if redis_client is None:
+        return
+    try:
+        await redis_client.set(USER_KEY_PREFIX + user.name,
+                               user.json(),
+                               ex=USER_CACHE_TTL)
+    except redis.RedisError:
+        pass
+
+
+async def invalidate_user(name: str,
+                          redis_client: aioredis.Redis | None = None):
+    """Drop a user from the cache.
+
+    Call after a user is deleted or changes password. Other workers keep
+    their in-memory copy for at most `USER_CACHE_TTL` seconds.
+    """
+    user_cache.delete(name)
+    if redis_client is None:
+        return
+    try:
+        await redis_client.delete(USER_KEY_PREFIX + name)
+    except redis.RedisError:
+        pass
+
+
+async def get_list_version(user_id: int,
+                           redis_client: aioredis.Redis | None = None) -> str:
+    """Current version of a user's item list.
+
+    Pages are cached under the version, so bumping it drops every
+    cached page of the user at once. Redis versions are prefixed so
+    they never match a page cached in memory while Redis was down.
+    """
+    if redis_client is not None:
+        try:
+            await bump_missed(redis_client)
+            version = await redis_client.get(LIST_VERSION_PREFIX +
+                                             str(user_id))
+            return f"r{version or 0}"
+        except redis.RedisError:
+            pass
+    return f"l{list_versions.get(user_id, 0)}"
+
+
+async def bump_missed(redis_client: aioredis.Redis):
+    """Bump the Redis versions that changed while Redis was down."""
+    while missed_bumps:
+        user_id = next(iter(missed_bumps))
+        await redis_client.incr(LIST_VERSION_PREFIX + str(user_id))
+        missed_bumps.discard(user_id)
+
+
+async def bump_list_version(user_id: int,
+                            redis_client: aioredis.Redis | None = None):
+    """Invalidate the cached list pages of a user, call after commit.
+
+    If Redis is down, its version is bumped once it answers again.
+    """
+    list_versions[user_id] = list_versions.get(user_id, 0) + 1
+    if redis_client is None:
+        return
+    try:
+        await bump_missed(redis_client)
+        await redis_client.incr(LIST_VERSION_PREFIX + str(user_id))
+    except redis.RedisError:
+        missed_bumps.add(user_id)
+
+
+async def get_cached_page(
+        user_id: int,
+        version: str,
+        page: str,
+        redis_client: aioredis.Redis | None = None) -> str | None:
+    """Serialized list page cached by `set_cached_page`, if any."""
+    key = f"{user_id}:{version}:{page}"
+    value = None
+    if version.startswith("r") and redis_client is not None:
+        try:
+            value = await redis_client.get(LIST_PAGE_PREFIX + key)
+        except redis.RedisError:
+            pass
+    elif LOCAL_LIST_CACHE:
+        value = list_cache.get(key)
+    list_stats.record(value is not None)
+    return value
+
+
+async def set_cached_page(user_id: int,
+                          version: str,
+                          page: str,
+                          value: str,
+                          redis_client: aioredis.Redis | None = None):
+    key = f"{user_id}:{version}:{page}"
+    if version.startswith("r") and redis_client is not None:
+        try:
+            await redis_client.set(LIST_PAGE_PREFIX + key,
+                                   value,
+                                   ex=LIST_CACHE_TTL)
+        except redis.RedisError:
+            pass
+    elif LOCAL_LIST_CACHE:
+        list_cache.set(key, value)
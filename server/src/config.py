@@ -2,12 +2,60 @@ import os
 from functools import cache
 from types import SimpleNamespace
 
+# Used when the environment variable is not set
+DEFAULTS = {
+    "bcrypt_rounds": "12",
+    "hash_workers": "2",
+    "hash_queue_limit": "32",
+    "thumbnail_workers": "2",
+    # uvicorn worker processes, uvicorn reads the same variable. More
+    # than one keeps list pages out of memory, as workers can't
+    # invalidate each other's.
+    "web_concurrency": "1",
+    "max_file_size": str(20 * 1024 * 1024),
+    "max_upload_size": str(100 * 1024 * 1024),
+    # `direct` streams files from Python, `nginx` hands them to nginx
+    # with X-Accel-Redirect
+    "file_serving": "direct",
+    "accel_redirect_prefix": "/protected-data",
+    "purge_retention_days": "30",
+    "purge_batch_size": "500",
+    # Seconds between in-process purges, 0 leaves purging to the CLI
+    "purge_interval": "3600",
+    # `requests/seconds` per client address, or per user for uploads,
+    # a limit of 0 disables
+    "login_rate_limit": "10/60",
+    "register_rate_limit": "10/3600",
+    "upload_rate_limit": "30/60",
+    # Seconds between writes of a worker's metrics for the others to
+    # read, 0 keeps `/metrics` to the worker serving it
+    "metrics_interval": "5",
+    # Log statements slower than this, 0 disables
+    "slow_query_ms": "0",
+    "explain_slow_queries": "false",
+    # Log the values bound to slow statements, not only their types.
+    # They include password hashes and memo text.
+    "log_query_params": "false",
+    # Warn in the dev stage when a request runs one statement more often
+    "n_plus_one_threshold": "10",
+}
+
 
 @cache
 def get_settings() -> SimpleNamespace:
     keys = [
         "secret_key", "algorithm", "access_token_expire_days", "redis_url",
-        "log_path", "database_url", "data_dir", "stage"
+        "log_path", "database_url", "data_dir", "stage", "bcrypt_rounds",
+        "hash_workers", "hash_queue_limit", "thumbnail_workers",
+        "web_concurrency", "file_serving", "accel_redirect_prefix",
+        "max_file_size", "max_upload_size", "purge_retention_days",
+        "purge_batch_size", "purge_interval", "login_rate_limit",
+        "register_rate_limit", "upload_rate_limit", "metrics_interval",
+        "slow_query_ms", "explain_slow_queries", "log_query_params",
+        "n_plus_one_threshold"
     ]
-    envs = {k.lower(): os.environ.get(k.upper(), 'null') for k in keys}
+    envs = {
+        k.lower(): os.environ.get(k.upper(), DEFAULTS.get(k, 'null'))
+        for k in keys
+    }
     return SimpleNamespace(**envs)
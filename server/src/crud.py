@@ -1,44 +1,45 @@
+import base64
+import binascii
 import os
+import re
 import time
+from collections import Counter
+from typing import Literal
 
-from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy import (Integer, cast, delete, func, insert, literal_column,
+                        or_, select, tuple_, update)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
-from src import schemas
+from src import cache, hashing, schemas, thumbnail
 from src.config import get_settings
-from src.database import Image, Item, User, UserStatistics
+from src.database import (TS_CONFIG, Blob, Image, Item, SearchTerm, User,
+                          UserStatistics)
 
 DATA_DIR = get_settings().data_dir
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def get_password_hash(password: str):
-    return pwd_context.hash(password)
+# Terms of a search query beyond this are ignored
+MAX_SEARCH_TERMS = 8
 
 
 def get_time():
     return int(time.time() * 1000)
 
 
-def get_user(db: Session, user_id: int):
-    return db.query(User).filter(User.id == user_id).first()
+async def get_user(db: AsyncSession, user_id: int):
+    return await db.scalar(select(User).where(User.id == user_id))
 
 
-def get_user_statistics(db: Session, user_id: int):
-    return db.query(UserStatistics).filter(
-        UserStatistics.user_id == user_id).first()
+async def get_user_statistics(db: AsyncSession, user_id: int):
+    return await db.scalar(
+        select(UserStatistics).where(UserStatistics.user_id == user_id))
 
 
-def get_me(db: Session, user_id: int):
-    user = db.query(User).filter(User.id == user_id).first()
+async def get_me(db: AsyncSession, user_id: int):
+    user = await get_user(db, user_id)
     if user is None:
         return None
-    user_stats = get_user_statistics(db, user_id)
+    user_stats = await get_user_statistics(db, user_id)
     if user_stats is None:
         return None
     return schemas.UserMe(id=user.id,
@@ -48,226 +49,773 @@ def get_me(db: Session, user_id: int):
                           created_time=user.created_time)
 
 
-def get_user_by_name(db: Session, name: str):
-    return db.query(User).filter(User.name == name).first()
+async def get_user_by_name(db: AsyncSession, name: str):
+    return await db.scalar(select(User).where(User.name == name))
 
 
-def get_users(db: Session, limit: int = 100):
-    return db.query(User).limit(limit).all()
+async def get_users(db: AsyncSession, limit: int = 100):
+    return (await db.scalars(select(User).limit(limit))).all()
 
 
-def authenticate_user(db: Session, name: str, password: str):
-    user = get_user_by_name(db, name)
+async def authenticate_user(db: AsyncSession, name: str, password: str):
+    """Raises `hashing.HashQueueFull` when the hash pool is saturated."""
+    user = await get_user_by_name(db, name)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await hashing.verify_password(password, user.hashed_password):
         return False
     return user
 
 
-def create_user_statistics(db: Session, user_id: int):
+async def create_user_statistics(db: AsyncSession, user_id: int):
     db_user_stats = UserStatistics(user_id=user_id,
                                    total_items=0,
                                    total_images=0)
     db.add(db_user_stats)
-    db.commit()
-    db.refresh(db_user_stats)
+    await db.commit()
     return db_user_stats
 
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed_password = get_password_hash(user.password)
+async def create_user(db: AsyncSession,
+                      user: schemas.UserCreate,
+                      hashed_password: str | None = None):
+    """Raises `hashing.HashQueueFull` when the hash pool is saturated."""
+    if hashed_password is None:
+        hashed_password = await hashing.get_password_hash(user.password)
     db_user = User(name=user.name,
                    hashed_password=hashed_password,
-                   created_time=get_time())
+                   created_time=get_time(),
+                   items=[])
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    create_user_statistics(db, user_id=db_user.id)  # type: ignore
+    await db.commit()
+    await create_user_statistics(db, user_id=db_user.id)  # type: ignore
     return db_user
 
 
-def verify_item(db: Session, user_id: int, item_id: int):
-    item = get_item(db, item_id)
-    if item is None:
+async def update_user_password(db: AsyncSession,
+                               user_id: int,
+                               password: str,
+                               redis_client=None):
+    db_user = await get_user(db, user_id)
+    if db_user is None:
         return None
-    return item.owner_id == user_id
+    db_user.hashed_password = await hashing.get_password_hash(  # type: ignore
+        password)
+    await db.commit()
+    await cache.invalidate_user(db_user.name, redis_client)  # type: ignore
+    return db_user
 
 
-def verify_image_owner(db: Session, user_id: int, image_id: int):
-    image = get_image(db, image_id)
+async def verify_image_owner(db: AsyncSession, user_id: int, image_id: int):
+    image = await get_image(db, image_id)
     if image is None:
         return None
     return image.owner_id == user_id
 
 
-def get_image(db: Session, image_id: int) -> Image | None:
-    return db.query(Image).filter(Image.id == image_id).first()
-
-
-def get_image_by_path(db: Session, path: str) -> Image | None:
-    return db.query(Image).filter(Image.data == path).first()
-
-
-def get_item(db: Session, item_id: int) -> Item | None:
-    return db.query(Item).filter(Item.id == item_id).first()
-
-
-def get_item_images(db: Session, item_id: int):
-    return db.query(Image).filter(Image.item_id == item_id).all()
-
-
-def get_user_items(db: Session,
-                   user_id: int,
-                   offset: int = 0,
-                   limit: int = 100):
-    res = db.query(Item).filter(
-        Item.owner_id == user_id, Item.deleted_at == None).order_by(
-            Item.created_time.desc()).offset(offset).limit(limit).all()
-
-    return res
-
+async def get_image(db: AsyncSession, image_id: int) -> Image | None:
+    return await db.scalar(select(Image).where(Image.id == image_id))
+
+
+async def get_image_by_path(db: AsyncSession, path: str) -> Image | None:
+    return await db.scalar(select(Image).where(Image.data == path))
+
+
+async def get_item(db: AsyncSession, item_id: int) -> Item | None:
+    """Item with all its images loaded."""
+    return await db.scalar(
+        select(Item).options(selectinload(Item.images)).where(
+            Item.id == item_id).execution_options(populate_existing=True))
+
+
+async def get_owned_item(db: AsyncSession, user_id: int,
+                         item_id: int) -> Item | Literal[False] | None:
+    """Item of `user_id` with all its images loaded.
+
+    Returns `None` if the item does not exist and `False` if it belongs
+    to someone else. The existence check only runs on the failure path.
+    """
+    item = await db.scalar(
+        select(Item).options(selectinload(Item.images)).where(
+            Item.id == item_id, Item.owner_id == user_id))
+    if item is not None:
+        return item
+    exists = await db.scalar(select(Item.id).where(Item.id == item_id))
+    return None if exists is None else False
+
+
+async def get_item_images(db: AsyncSession, item_id: int):
+    return (await
+            db.scalars(select(Image).where(Image.item_id == item_id))).all()
+
+
+def encode_cursor(sort_value: int, item_id: int) -> str:
+    """Opaque keyset cursor pointing after `(sort_value, item_id)`."""
+    raw = f"{sort_value}.{item_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[int, int]:
+    """Raises `ValueError` if the cursor is malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        sort_value, item_id = raw.split(".")
+        return int(sort_value), int(item_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+async def get_user_items(db: AsyncSession,
+                         user_id: int,
+                         offset: int = 0,
+                         limit: int = 100,
+                         cursor: str | None = None):
+    """Items and their live images in two queries.
+
+    Newest first. With a `cursor` the page starts right after the cursor
+    position and `offset` is ignored.
+    """
+    query = select(Item).options(
+        selectinload(Item.images.and_(Image.deleted_at == None))).where(
+            Item.owner_id == user_id,
+            Item.deleted_at == None).order_by(Item.created_time.desc(),
+                                              Item.id.desc())
+    if cursor is not None:
+        query = query.where(
+            tuple_(Item.created_time, Item.id) < tuple_(
+                *decode_cursor(cursor)))
+    else:
+        query = query.offset(offset)
+    return (await db.scalars(query.limit(limit))).all()
+
+
+async def get_deleted_items(db: AsyncSession,
+                            user_id: int,
+                            offset: int = 0,
+                            limit: int = 100,
+                            cursor: str | None = None):
+    """Deleted items with the images that were deleted along with them.
+
+    Images removed by an edit before the item was deleted are left out.
+    Most recently deleted first, paginated like `get_user_items`.
+    """
+    item_deleted_at = select(
+        Item.deleted_at).where(Item.id == Image.item_id).scalar_subquery()
+    query = select(Item).options(
+        selectinload(
+            Item.images.and_(
+                or_(Image.deleted_at == None,
+                    Image.deleted_at >= item_deleted_at)))).where(
+                        Item.owner_id == user_id,
+                        Item.deleted_at != None).order_by(
+                            Item.deleted_at.desc(), Item.id.desc())
+    if cursor is not None:
+        query = query.where(
+            tuple_(Item.deleted_at, Item.id) < tuple_(*decode_cursor(cursor)))
+    else:
+        query = query.offset(offset)
+    return (await db.scalars(query.limit(limit))).all()
+
+
+def tokenize(text: str | None) -> list[str]:
+    """Lowercased words, close to the Postgres `simple` configuration."""
+    return re.findall(r"\w+", (text or "").lower())
+
+
+def has_text_search(db: AsyncSession) -> bool:
+    """Whether the database indexes item text itself."""
+    return db.bind.dialect.name == "postgresql"
+
+
+async def index_item_text(db: AsyncSession,
+                          db_item: Item,
+                          replace: bool = True):
+    """Write the `SearchTerm` rows of an item, without committing.
+
+    Postgres keeps its expression index up to date by itself. Deleted
+    items keep their terms so restoring them needs no reindex, searches
+    skip them.
+    """
+    if has_text_search(db):
+        return
+    if replace:
+        await db.execute(
+            delete(SearchTerm).where(SearchTerm.item_id == db_item.id))
+    rows = search_term_rows(db_item)
+    if rows:
+        await db.execute(insert(SearchTerm), rows)
+
+
+def search_term_rows(db_item: Item) -> list[dict]:
+    counts = Counter(tokenize(db_item.text))  # type: ignore
+    return [{
+        "term": term,
+        "item_id": db_item.id,
+        "owner_id": db_item.owner_id,
+        "count": n
+    } for term, n in counts.items()]
+
+
+async def rebuild_search_index(db: AsyncSession, chunk_size: int = 500):
+    """Index the text of every item, for data written before search."""
+    if has_text_search(db):
+        return
+    await db.execute(delete(SearchTerm))
+    result = await db.stream_scalars(
+        select(Item).execution_options(yield_per=chunk_size))
+    async for items in result.partitions():
+        for db_item in items:
+            await index_item_text(db, db_item, replace=False)
+    await db.commit()
+
+
+async def search_items(db: AsyncSession,
+                       user_id: int,
+                       query: str,
+                       limit: int = 100,
+                       cursor: str | None = None):
+    """Live items whose text contains every word of `query`.
+
+    Best match first. Each item gets a `search_rank`, the sort key of
+    its cursor. Postgres ranks with `ts_rank` over the GIN index,
+    elsewhere the rank is how often the words occur in the item.
+    """
+    if has_text_search(db):
+        vector = func.to_tsvector(literal_column(f"'{TS_CONFIG}'"), Item.text)
+        ts_query = func.plainto_tsquery(literal_column(f"'{TS_CONFIG}'"),
+                                        query)
+        rank = cast(func.ts_rank(vector, ts_query) * 1000000, Integer)
+        stmt = select(Item, rank).where(vector.op("@@")(ts_query))
+    else:
+        terms = list(dict.fromkeys(tokenize(query)))[:MAX_SEARCH_TERMS]
+        if not terms:
+            return []
+        matches = select(SearchTerm.item_id,
+                         func.sum(SearchTerm.count).label("rank")).where(
+                             SearchTerm.owner_id == user_id,
+                             SearchTerm.term.in_(terms)).group_by(
+                                 SearchTerm.item_id).having(
+                                     func.count() == len(terms)).subquery()
+        rank = matches.c.rank
+        stmt = select(Item, rank).join(matches, Item.id == matches.c.item_id)
+    stmt = stmt.options(
+        selectinload(Item.images.and_(Image.deleted_at == None))).where(
+            Item.owner_id == user_id,
+            Item.deleted_at == None).order_by(rank.desc(), Item.id.desc())
+    if cursor is not None:
+        stmt = stmt.where(
+            tuple_(rank, Item.id) < tuple_(*decode_cursor(cursor)))
+    items = []
+    for db_item, item_rank in (await db.execute(stmt.limit(limit))).all():
+        db_item.search_rank = item_rank
+        items.append(db_item)
+    return items
+
+
+async def stream_user_items(db: AsyncSession,
+                            user_id: int,
+                            chunk_size: int = 100):
+    """Yield live items with their live images, `chunk_size` at a time.
+
+    The session is emptied once the caller is done with a chunk, so
+    memory stays flat however many items the user has.
+    """
+    result = await db.stream_scalars(
+        select(Item).options(
+            selectinload(Item.images.and_(Image.deleted_at == None))).where(
+                Item.owner_id == user_id, Item.deleted_at == None).order_by(
+                    Item.created_time,
+                    Item.id).execution_options(yield_per=chunk_size))
+    async for items in result.partitions():
+        yield items
+        db.expunge_all()
+
+
+async def stream_user_image_paths(db: AsyncSession,
+                                  user_id: int,
+                                  chunk_size: int = 100):
+    """Yield stored paths of the images of live items in chunks."""
+    result = await db.stream_scalars(
+        select(Image.data).join(Item).where(
+            Image.owner_id == user_id, Image.deleted_at == None,
+            Item.deleted_at == None).distinct().order_by(
+                Image.data).execution_options(yield_per=chunk_size))
+    async for paths in result.partitions():
+        yield paths
+
+
+async def get_changed_items(db: AsyncSession,
+                            user_id: int,
+                            since: int,
+                            until: int,
+                            limit: int = 100,
+                            cursor: str | None = None):
+    """Items, deleted or not, updated in `(since, until]`.
+
+    Oldest change first, with their live images. Paginated with a cursor
+    on `updated_time`, since many items can share one timestamp.
+    """
+    query = select(Item).options(
+        selectinload(Item.images.and_(Image.deleted_at == None))).where(
+            Item.owner_id == user_id, Item.updated_time > since,
+            Item.updated_time <= until).order_by(Item.updated_time, Item.id)
+    if cursor is not None:
+        query = query.where(
+            tuple_(Item.updated_time, Item.id) > tuple_(
+                *decode_cursor(cursor)))
+    return (await db.scalars(query.limit(limit))).all()
+
+
+def next_cursor(items: list[Item], limit: int, sort_key: str) -> str | None:
+    """Cursor for the page after `items`, `None` on the last page."""
+    if len(items) < limit:
+        return None
+    last = items[-1]
+    return encode_cursor(getattr(last, sort_key), last.id)  # type: ignore
 
-def get_deleted_items(db: Session,
-                      user_id: int,
-                      offset: int = 0,
-                      limit: int = 100):
-    return db.query(Item).filter(
-        Item.owner_id == user_id, Item.deleted_at != None).order_by(
-            Item.deleted_at.desc()).offset(offset).limit(limit).all()
 
+async def update_user_statistics(db: AsyncSession,
+                                 user_id: int,
+                                 diff_items: int = 0,
+                                 diff_images: int = 0):
+    """Adjust the counters in place, without committing.
 
-def update_user_statistics(db: Session,
-                           user_id: int,
-                           diff_items: int = 0,
-                           diff_images: int = 0):
-    user_stats = get_user_statistics(db, user_id)
-    user_stats.total_items += diff_items  # type: ignore
-    user_stats.total_images += diff_images  # type: ignore
-    db.commit()
-    return user_stats
-
-
-def create_images(db: Session, item_id: int, images: list[str],
-                  file_types: list[str], user_id: int):
-    """Save image uuid names to database."""
+    A single `UPDATE ... SET total = total + n` so concurrent writers
+    cannot lose each other's updates.
+    """
+    if not diff_items and not diff_images:
+        return
+    await db.execute(
+        update(UserStatistics).where(UserStatistics.user_id == user_id).values(
+            total_items=UserStatistics.total_items + diff_items,
+            total_images=UserStatistics.total_images +
+            diff_images).execution_options(synchronize_session=False))
+
+
+def recount_user_statistics(user_ids: list[int]):
+    """`UPDATE` setting the statistics of `user_ids` to their counts of
+    live items and images."""
+    items = select(func.count(Item.id)).where(
+        Item.owner_id == UserStatistics.user_id, Item.deleted_at == None)
+    images = select(func.count(Image.id)).where(
+        Image.owner_id == UserStatistics.user_id, Image.deleted_at == None)
+    return update(UserStatistics).where(
+        UserStatistics.user_id.in_(user_ids)).values(
+            total_items=items.scalar_subquery(),
+            total_images=images.scalar_subquery()).execution_options(
+                synchronize_session=False)
+
+
+async def acquire_blobs(db: AsyncSession, paths: list[str]):
+    """Add one reference per path to the shared stored files."""
+    if not paths:
+        return
+    if db.bind.dialect.name == "postgresql":
+        upsert = postgresql.insert(Blob)
+    else:
+        upsert = sqlite.insert(Blob)
+    await db.execute(
+        upsert.on_conflict_do_update(
+            index_elements=[Blob.path],
+            set_={"ref_count": Blob.ref_count + upsert.excluded.ref_count}),
+        [{
+            "path": path,
+            "ref_count": n
+        } for path, n in Counter(paths).items()])
+
+
+async def release_blobs(db: AsyncSession, paths: list[str]) -> list[str]:
+    """Drop one reference per path, return paths that are now unused.
+
+    Files stored before deduplication have no `Blob` row and are only
+    used once. The caller removes the files with `remove_unused_files`
+    before committing.
+    """
+    unused = []
+    for path, n in Counter(paths).items():
+        result = await db.execute(
+            update(Blob).where(Blob.path == path).values(
+                ref_count=Blob.ref_count -
+                n).execution_options(synchronize_session=False))
+        if result.rowcount == 0:
+            unused.append(path)
+            continue
+        result = await db.execute(
+            delete(Blob).where(Blob.path == path,
+                               Blob.ref_count <= 0).execution_options(
+                                   synchronize_session=False))
+        if result.rowcount:
+            unused.append(path)
+    return unused
+
+
+async def get_blob_paths(db: AsyncSession, paths: list[str]) -> set[str]:
+    """The subset of `paths` that images reference."""
+    if not paths:
+        return set()
+    return set(
+        (await
+         db.scalars(select(Blob.path).where(Blob.path.in_(paths)))).all())
+
+
+async def remove_unused_files(db: AsyncSession, paths: list[str]) -> list[str]:
+    """Remove the files of `paths` no `Blob` row references, return them.
+
+    Runs in the transaction that released them: an upload takes its
+    reference before reusing a file, see `upload.BlobWriter.close`, and
+    waits on the rows deleted here until this transaction ends.
+    """
+    in_use = await get_blob_paths(db, paths)
+    unused = [path for path in paths if path not in in_use]
+    remove_stored_files(unused)
+    return unused
+
+
+def remove_stored_files(paths: list[str]):
+    """Remove files and their resized variants from disk."""
+    for path in paths:
+        for name in [path, *thumbnail.variant_names(path)]:
+            try:
+                os.remove(os.path.join(DATA_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+async def create_images(db: AsyncSession, item_id: int, images: list[str],
+                        file_types: list[str], user_id: int) -> int:
+    """Bulk insert stored file names, without committing.
+
+    Returns the number of images added.
+    """
     if not images:
-        return None
-    for filename, file_type in zip(images, file_types):
-        db_image = Image(data=filename,
-                         item_id=item_id,
-                         file_type=file_type,
-                         owner_id=user_id,
-                         created_at=get_time())
-        db.add(db_image)
-    db.commit()
-    update_user_statistics(db, user_id, 0, len(images))
-    # db.refresh(db_image)
-    return True
-
-
-def create_user_item(db: Session, user_id: int, text: str, paths: list[str],
-                     file_types: list[str]):
+        return 0
+    timenow = get_time()
+    await db.execute(insert(Image), [{
+        "data": filename,
+        "item_id": item_id,
+        "file_type": file_type,
+        "owner_id": user_id,
+        "created_at": timenow,
+    } for filename, file_type in zip(images, file_types)])
+    await acquire_blobs(db, images)
+    return len(images)
+
+
+async def create_user_item(db: AsyncSession,
+                           user_id: int,
+                           text: str,
+                           paths: list[str],
+                           file_types: list[str],
+                           redis_client=None):
     timenow = get_time()
     db_item = Item(text=text,
                    owner_id=user_id,
                    created_time=timenow,
                    updated_time=timenow)
     db.add(db_item)
-    db.commit()
-    db.refresh(db_item)
-    update_user_statistics(db, user_id, 1, 0)
-    create_images(
+    await db.flush()
+    await index_item_text(db, db_item, replace=False)
+    added = await create_images(
         db,
         item_id=db_item.id,  # type: ignore
         images=paths,
         file_types=file_types,
         user_id=user_id)
-    return db_item
+    await update_user_statistics(db, user_id, 1, added)
+    await db.commit()
+    await cache.bump_list_version(user_id, redis_client)
+    return await get_item(db, db_item.id)  # type: ignore
 
 
-def delete_item_images_hard(db: Session, item_id: int):
-    images = get_item_images(db, item_id)
-    for img in images:
-        db.delete(img)
-    db.commit()
+async def delete_item_images_hard(db: AsyncSession, item_id: int):
+    images = await get_item_images(db, item_id)
+    await delete_images_hard(db, item_id, [img.id for img in images])
     return True
 
 
-def delete_user_item(db: Session, item_id: int, user_id: int):
-    """Set `deleted_at` to timestamp and hard delete after 30 days."""
-    if not verify_item(db, user_id, item_id):
-        return False
-    db_item = get_item(db, item_id)
-    if db_item is None or db_item.deleted_at is not None:
+async def delete_user_item(db: AsyncSession,
+                           item_id: int,
+                           user_id: int,
+                           redis_client=None):
+    """Set `deleted_at` to timestamp, `src.purge` hard deletes it after
+    the retention period."""
+    db_item = await get_owned_item(db, user_id, item_id)
+    if not db_item or db_item.deleted_at is not None:
         return False
-    # delete_files_s3(db_item.images)
-    # delete_item_images_hard(db, item_id)
-    # db.delete(db_item)
-    db_item.deleted_at = get_time()  # type: ignore
-    update_user_statistics(db, user_id, -1, 0)
-    delete_images_soft(db, item_id, get_item_images(db, item_id))
-    db.commit()
+    timenow = get_time()
+    db_item.deleted_at = timenow  # type: ignore
+    db_item.updated_time = timenow  # type: ignore
+    live_images = [img.id for img in db_item.images if img.deleted_at is None]
+    deleted = delete_images_soft(db_item, live_images, timenow)
+    await update_user_statistics(db, user_id, -1, -deleted)
+    await db.commit()
+    await cache.bump_list_version(user_id, redis_client)
     return db_item
 
 
-def delete_images_soft(db: Session, item_id: int, images: list[int]):
-    """Set `deleted_at` to timestamp and hard delete later."""
+def delete_images_soft(db_item: Item,
+                       images: list[int],
+                       timestamp: int | None = None) -> int:
+    """Set `deleted_at` to timestamp and hard delete later.
+
+    Works on the images already loaded with `db_item`; the change is
+    flushed with the caller's commit. Returns the number of images that
+    were actually deleted.
+    """
     if not images:
-        return
-    orig_imgs = get_item_images(db, item_id)
+        return 0
     del_imgs = set(images)
-    for img in orig_imgs:
-        if img.id in del_imgs:
-            img.deleted_at = get_time()
-    update_user_statistics(db, orig_imgs[0].owner_id, 0, -len(del_imgs))
-    db.commit()
-
-
-def delete_images_hard(db: Session, item_id: int, images: list[int]):
-    """Remove images from database, S3 and disk."""
-    orig_imgs = get_item_images(db, item_id)
+    timestamp = timestamp or get_time()
+    deleted = 0
+    for img in db_item.images:
+        if img.id in del_imgs and img.deleted_at is None:
+            img.deleted_at = timestamp
+            deleted += 1
+    return deleted
+
+
+async def delete_images_hard(db: AsyncSession,
+                             item_id: int,
+                             images: list[int],
+                             redis_client=None):
+    """Remove images from database.
+
+    Files shared with other images stay on disk until the last one goes.
+    """
+    orig_imgs = await get_item_images(db, item_id)
     del_imgs = set(images)
+    paths = []
+    owners = set()
     for img in orig_imgs:
         if img.id in del_imgs:
-            db.delete(img)
-            os.remove(os.path.join(DATA_DIR, img.data))
-    db.commit()
-
-
-def update_user_item(db: Session, user_id: int, item_id: int, text: str,
-                     img_ids: list[int], add_file_paths: list[str],
-                     file_types: list[str]):
-    if not verify_item(db, user_id, item_id):
-        return False
-    db_item = get_item(db, item_id)
-    if db_item is None:
+            await db.delete(img)
+            paths.append(img.data)
+            owners.add(img.owner_id)
+            cache.image_cache.delete(img.id)
+    unused = await release_blobs(db, paths)
+    await remove_unused_files(db, unused)
+    await db.commit()
+    for user_id in owners:
+        await cache.bump_list_version(user_id, redis_client)
+
+
+async def update_user_item(db: AsyncSession,
+                           user_id: int,
+                           item_id: int,
+                           text: str,
+                           img_ids: list[int],
+                           add_file_paths: list[str],
+                           file_types: list[str],
+                           redis_client=None):
+    db_item = await get_owned_item(db, user_id, item_id)
+    if not db_item:
         return False
 
-    if text != db_item.text or img_ids or add_file_paths:
+    text_changed = text != db_item.text
+    if text_changed or img_ids or add_file_paths:
         db_item.updated_time = get_time()  # type: ignore
 
     db_item.text = text  # type: ignore
-    delete_images_soft(db, item_id, img_ids)
-    create_images(
+    if text_changed:
+        await index_item_text(db, db_item)
+    deleted = delete_images_soft(db_item, img_ids)
+    added = await create_images(
         db,
         item_id=db_item.id,  # type: ignore
         images=add_file_paths,
         file_types=file_types,
         user_id=user_id)
-    db.commit()
-    return db_item
-
-
-def restore_item(db: Session, item_id: int, user_id: int):
-    if not verify_item(db, user_id, item_id):
-        return False
-    db_item = get_item(db, item_id)
-    if db_item is None:
+    await update_user_statistics(db, user_id, 0, added - deleted)
+    await db.commit()
+    await cache.bump_list_version(user_id, redis_client)
+    return await get_item(db, item_id)
+
+
+async def restore_item(db: AsyncSession,
+                       item_id: int,
+                       user_id: int,
+                       redis_client=None):
+    """Restore a deleted item with the images deleted along with it."""
+    db_item = await get_owned_item(db, user_id, item_id)
+    if not db_item or db_item.deleted_at is None:
         return False
-    db_item.deleted_at = None  # type: ignore
+    restored = 0
     for image in db_item.images:
-        image.deleted_at = None
-    update_user_statistics(db, user_id, 1, len(db_item.images))
-    db.commit()
+        if image.deleted_at is not None \
+                and image.deleted_at >= db_item.deleted_at:
+            image.deleted_at = None
+            restored += 1
+    db_item.deleted_at = None  # type: ignore
+    db_item.updated_time = get_time()  # type: ignore
+    await update_user_statistics(db, user_id, 1, restored)
+    await db.commit()
+    await cache.bump_list_version(user_id, redis_client)
     return db_item
+
+
+async def batch_items(db: AsyncSession,
+                      user_id: int,
+                      operations: list[schemas.BatchOperation],
+                      redis_client=None) -> list[schemas.BatchResult]:
+    """Create, delete and restore many items in one transaction.
+
+    Each kind of operation is one bulk statement per table, guarded by
+    `owner_id`, and the statistics are updated once. Returns a result
+    per operation, in order. An item may appear only once per batch.
+    """
+    timenow = get_time()
+    results: list[schemas.BatchResult] = []
+    seen: set[int] = set()
+    wanted: dict[str, set[int]] = {"delete": set(), "restore": set()}
+    created: list[Item] = []
+    for op in operations:
+        result = schemas.BatchResult(op=op.op, id=op.id, ok=True)
+        if op.op == "create":
+            db_item = Item(text=op.text,
+                           owner_id=user_id,
+                           created_time=timenow,
+                           updated_time=timenow)
+            created.append(db_item)
+            result.id = None
+        elif op.id is None:
+            result.ok, result.detail = False, "Missing item id"
+        elif op.id in seen:
+            result.ok, result.detail = False, "Item already in this batch"
+        else:
+            seen.add(op.id)
+            wanted[op.op].add(op.id)
+        results.append(result)
+
+    if created:
+        db.add_all(created)
+        await db.flush()
+        rows = [
+            row for db_item in created for row in search_term_rows(db_item)
+        ]
+        if rows and not has_text_search(db):
+            await db.execute(insert(SearchTerm), rows)
+
+    targets = wanted["delete"] | wanted["restore"]
+    found = []
+    if targets:
+        found = (await db.execute(
+            select(Item.id,
+                   Item.deleted_at).where(Item.id.in_(targets),
+                                          Item.owner_id == user_id))).all()
+    deleted = {
+        row.id
+        for row in found
+        if row.id in wanted["delete"] and row.deleted_at is None
+    }
+    restored = {
+        row.id
+        for row in found
+        if row.id in wanted["restore"] and row.deleted_at is not None
+    }
+    diff_items, diff_images = len(created), 0
+    if deleted:
+        items = await db.execute(
+            update(Item).where(Item.id.in_(deleted), Item.owner_id == user_id,
+                               Item.deleted_at == None).values(
+                                   deleted_at=timenow,
+                                   updated_time=timenow).execution_options(
+                                       synchronize_session=False))
+        images = await db.execute(
+            update(Image).where(Image.item_id.in_(deleted),
+                                Image.deleted_at == None).values(
+                                    deleted_at=timenow).execution_options(
+                                        synchronize_session=False))
+        diff_items -= items.rowcount
+        diff_images -= images.rowcount
+    if restored:
+        # Only the images deleted along with the item, as `restore_item`
+        item_deleted_at = select(
+            Item.deleted_at).where(Item.id == Image.item_id).scalar_subquery()
+        images = await db.execute(
+            update(Image).where(Image.item_id.in_(restored),
+                                Image.deleted_at != None,
+                                Image.deleted_at >= item_deleted_at).values(
+                                    deleted_at=None).execution_options(
+                                        synchronize_session=False))
+        items = await db.execute(
+            update(Item).where(Item.id.in_(restored), Item.owner_id == user_id,
+                               Item.deleted_at != None).values(
+                                   deleted_at=None,
+                                   updated_time=timenow).execution_options(
+                                       synchronize_session=False))
+        diff_items += items.rowcount
+        diff_images += images.rowcount
+    await update_user_statistics(db, user_id, diff_items, diff_images)
+    await db.commit()
+    await cache.bump_list_version(user_id, redis_client)
+
+    new_ids = iter(db_item.id for db_item in created)
+    done = {"delete": deleted, "restore": restored}
+    for result in results:
+        if result.op == "create":
+            result.id = next(new_ids)
+        elif result.ok and result.id not in done[result.op]:
+            result.ok, result.detail = False, "Item not found"
+    return results
+
+
+async def purge_expired(db: AsyncSession, before: int,
+                        limit: int) -> tuple[int, int, int] | None:
+    """Hard delete one batch of items and images soft deleted before
+    `before`, with the files nothing else uses.
+
+    A batch is up to `limit` expired items with all their images, plus up
+    to `limit` expired images of other items. Returns the number of
+    items, images and files removed, all zero when nothing has expired,
+    or `None` if a concurrent purge or restore got to some rows first and
+    the batch was rolled back.
+
+    Soft deleted rows are already out of the statistics, only images
+    still live when deleted here are subtracted.
+    """
+    expired_items = select(Item.id, Item.owner_id).where(
+        Item.deleted_at != None,
+        Item.deleted_at < before).order_by(Item.deleted_at).limit(limit)
+    items = (await db.execute(expired_items)).all()
+    item_ids = [row.id for row in items]
+    columns = (Image.id, Image.data, Image.owner_id, Image.deleted_at)
+    expired_images = select(*columns).where(
+        Image.deleted_at != None,
+        Image.deleted_at < before).order_by(Image.deleted_at).limit(limit)
+    rows = (await db.execute(expired_images)).all()
+    if item_ids:
+        item_images = select(*columns).where(Image.item_id.in_(item_ids))
+        rows += (await db.execute(item_images)).all()
+    images = {row.id: row for row in rows}
+    if not item_ids and not images:
+        return 0, 0, 0
+
+    if item_ids:
+        await db.execute(
+            delete(SearchTerm).where(SearchTerm.item_id.in_(item_ids)))
+    # Rows restored since they were selected no longer match
+    deletes = (
+        delete(Image).where(
+            Image.id.in_(list(images)),
+            or_(Image.deleted_at != None, Image.item_id.in_(item_ids))),
+        delete(Item).where(Item.id.in_(item_ids), Item.deleted_at != None),
+    )
+    for stmt, ids in zip(deletes, (images, item_ids)):
+        result = await db.execute(
+            stmt.execution_options(synchronize_session=False))
+        if result.rowcount != len(ids):
+            await db.rollback()
+            return None
+    unused = await release_blobs(db, [row.data for row in images.values()])
+    live_images: dict[int, int] = {}
+    for row in images.values():
+        if row.deleted_at is None:
+            live_images[row.owner_id] = live_images.get(row.owner_id, 0) + 1
+    for owner_id, count in live_images.items():
+        await update_user_statistics(db, owner_id, 0, -count)
+    removed = await remove_unused_files(db, unused)
+    await db.commit()
+    for image_id in images:
+        cache.image_cache.delete(image_id)
+    return len(item_ids), len(images), len(removed)
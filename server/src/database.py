@@ -1,16 +1,39 @@
-import redis
+from redis import asyncio as aioredis
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy import (BigInteger, Column, ForeignKey, Integer, String,
-                        create_engine)
+from sqlalchemy import (DDL, BigInteger, Column, ForeignKey, Index, Integer,
+                        String, create_engine, event, text)
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 
 from src.config import get_settings
 
 DATABASE_URL = get_settings().database_url
-engine = create_engine(DATABASE_URL)
+# SQLite connections are shared between the threadpool workers
+connect_args = ({
+    "check_same_thread": False
+} if DATABASE_URL.startswith("sqlite") else {})
+engine = create_engine(DATABASE_URL, connect_args=connect_args)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def get_async_url(url: str) -> str:
+    """Swap the sync driver of `DATABASE_URL` for an asyncio one."""
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url
+
+
+async_engine = create_async_engine(get_async_url(DATABASE_URL))
+# Keep attributes loaded after commit, lazy loads are not allowed
+# on async sessions.
+AsyncSessionLocal = sessionmaker(async_engine,
+                                 class_=AsyncSession,
+                                 autoflush=False,
+                                 expire_on_commit=False)
+
 Base = declarative_base()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
@@ -24,14 +47,55 @@ def get_db():
         db.close()
 
 
-def get_redis():
-    settings = get_settings()
-    redis_client = redis.Redis.from_url(settings.redis_url,
-                                        decode_responses=True)
-    try:
-        yield redis_client
-    finally:
-        redis_client.close()
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+_redis_pool: aioredis.ConnectionPool | None = None
+
+
+def get_redis_pool() -> aioredis.ConnectionPool:
+    """The connection pool shared by every request of this process."""
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = aioredis.ConnectionPool.from_url(
+            get_settings().redis_url, decode_responses=True)
+    return _redis_pool
+
+
+async def close_redis_pool():
+    global _redis_pool
+    if _redis_pool is not None:
+        await _redis_pool.disconnect()
+        _redis_pool = None
+
+
+async def get_redis():
+    """Yields an asyncio client on the shared pool, `None` when
+    `REDIS_URL` is not configured."""
+    if get_settings().redis_url == 'null':
+        yield None
+        return
+    yield aioredis.Redis(connection_pool=get_redis_pool())
+
+
+def partial(where: str) -> dict:
+    """Options of an index over the rows matching `where`. Queries must
+    filter on the same condition for the planner to use it."""
+    clause = text(where)
+    return {"postgresql_where": clause, "sqlite_where": clause}
+
+
+LIVE = "deleted_at IS NULL"
+DELETED = "deleted_at IS NOT NULL"
+
+
+class SchemaVersion(Base):  # type: ignore
+    """Migrations of `src.migrate` applied to this database."""
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+    applied_at = Column(BigInteger)
 
 
 class User(Base):  # type: ignore
@@ -51,6 +115,10 @@ class UserStatistics(Base):  # type: ignore
     total_items = Column(Integer)
     total_images = Column(Integer)
 
+    __table_args__ = (Index("ix_user_statistics_user_id",
+                            "user_id",
+                            unique=True), )
+
 
 class Item(Base):  # type: ignore
     __tablename__ = "items"
@@ -60,15 +128,40 @@ class Item(Base):  # type: ignore
     updated_time = Column(BigInteger)
     owner_id = Column(Integer, ForeignKey("users.id"))
     owner = relationship("User", back_populates="items")
-    images = relationship("Image", back_populates="item")
+    # Upload order, which no index of images keeps by itself
+    images = relationship("Image", back_populates="item", order_by="Image.id")
     deleted_at = Column(BigInteger, nullable=True)
 
+    __table_args__ = (
+        # Keyset pagination of /item/list and /item/recycle, counts of
+        # live items
+        Index("ix_items_live", "owner_id", "created_time", "id",
+              **partial(LIVE)),
+        Index("ix_items_recycled", "owner_id", "deleted_at", "id",
+              **partial(DELETED)),
+        # /item/changes
+        Index("ix_items_owner_updated", "owner_id", "updated_time", "id"),
+        # Expired rows for `src.purge`
+        Index("ix_items_expired", "deleted_at", **partial(DELETED)),
+    )
+
     def as_dict(self):
         d = {c.name: getattr(self, c.name) for c in self.__table__.columns}
         d['images'] = [i.data for i in self.images]
         return d
 
 
+# Text search configuration of the Postgres full-text index
+TS_CONFIG = "simple"
+# Expression index searched by `crud.search_items`, the query must use
+# the same expression for the planner to pick it.
+TEXT_SEARCH_INDEX = DDL(
+    f"CREATE INDEX IF NOT EXISTS ix_items_text_search ON items "
+    f"USING gin (to_tsvector('{TS_CONFIG}', text))")
+event.listen(Item.__table__, "after_create",
+             TEXT_SEARCH_INDEX.execute_if(dialect="postgresql"))
+
+
 class Image(Base):  # type: ignore
     __tablename__ = "images"
     id = Column(Integer, primary_key=True)
@@ -80,3 +173,35 @@ class Image(Base):  # type: ignore
     owner = relationship("User", back_populates="images")
     deleted_at = Column(BigInteger, nullable=True)
     created_at = Column(BigInteger)
+
+    __table_args__ = (
+        # Images of loaded items, updates along with their item
+        Index("ix_images_item", "item_id", "deleted_at"),
+        # Counts and stored paths of a user's live images
+        Index("ix_images_live_owner", "owner_id", "data", **partial(LIVE)),
+        # `crud.get_image_by_path`
+        Index("ix_images_data", "data"),
+        # Expired rows for `src.purge`
+        Index("ix_images_expired", "deleted_at", **partial(DELETED)),
+    )
+
+
+class Blob(Base):  # type: ignore
+    """A stored file, shared by every `Image` with the same content."""
+    __tablename__ = "blobs"
+    id = Column(Integer, primary_key=True)
+    path = Column(String, unique=True)
+    ref_count = Column(Integer, default=0)
+
+
+class SearchTerm(Base):  # type: ignore
+    """Inverted index of item text, for databases without full-text
+    search. Maintained by `crud`."""
+    __tablename__ = "search_terms"
+    term = Column(String, primary_key=True)
+    item_id = Column(Integer, ForeignKey("items.id"), primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"))
+    count = Column(Integer)
+
+    __table_args__ = (Index("ix_search_terms_owner_term", "owner_id", "term",
+                            "item_id"), )
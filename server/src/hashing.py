@@ -0,0 +1,93 @@
+"""Password hashing on a bounded thread pool.
+
+bcrypt costs 100+ ms of CPU per call. Running it on the event loop stalls
+every other request on the worker, so the async helpers here hand it to a
+small dedicated pool and refuse new work once `HASH_QUEUE_LIMIT` calls are
+waiting.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+from src.config import get_settings
+
+settings = get_settings()
+BCRYPT_ROUNDS = int(settings.bcrypt_rounds)
+HASH_WORKERS = int(settings.hash_workers)
+HASH_QUEUE_LIMIT = int(settings.hash_queue_limit)
+
+logger = logging.getLogger(__name__)
+pwd_context = CryptContext(schemes=["bcrypt"],
+                           deprecated="auto",
+                           bcrypt__rounds=BCRYPT_ROUNDS)
+executor = ThreadPoolExecutor(max_workers=HASH_WORKERS,
+                              thread_name_prefix="bcrypt")
+
+
+class HashQueueFull(Exception):
+    """Too many hash calls are already running or waiting."""
+
+
+class HashStats:
+    """Running cost of hash calls, for tuning `BCRYPT_ROUNDS`."""
+
+    def __init__(self):
+        self.calls = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.pending = 0
+
+    def record(self, seconds: float):
+        self.calls += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.total_seconds / self.calls if self.calls else 0.0
+
+
+stats = HashStats()
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        elapsed = time.perf_counter() - start
+        stats.record(elapsed)
+        logger.debug("%s took %.1f ms (rounds=%d)", func.__name__,
+                     elapsed * 1000, BCRYPT_ROUNDS)
+
+
+async def _run(func, *args):
+    if stats.pending >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        raise HashQueueFull()
+    stats.pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, _timed, func, *args)
+    finally:
+        stats.pending -= 1
+
+
+def verify_password_sync(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def get_password_hash_sync(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Raises `HashQueueFull` when the pool is saturated."""
+    return await _run(verify_password_sync, plain_password, hashed_password)
+
+
+async def get_password_hash(password: str) -> str:
+    """Raises `HashQueueFull` when the pool is saturated."""
+    return await _run(get_password_hash_sync, password)
@@ -3,9 +3,11 @@ import logging.handlers
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
 from src.config import get_settings
-from src.database import Base, engine
+from src.database import Base, async_engine, close_redis_pool, engine
+from src import metrics, purge, querylog, thumbnail
 from src.routers import auth, item, user, data
 
 settings = get_settings()
@@ -27,7 +29,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[item.NEXT_CURSOR_HEADER],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument(engine)
+metrics.instrument(async_engine.sync_engine)
+querylog.instrument(engine)
+querylog.instrument(async_engine.sync_engine)
 
 
 @app.on_event("startup")
@@ -40,8 +48,24 @@ async def startup_event():
     handler.setFormatter(
         logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
     logger.addHandler(handler)
+    purge.start()
+    metrics.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await purge.stop()
+    await metrics.stop()
+    thumbnail.shutdown()
+    await close_redis_pool()
 
 
 @app.get("/")
 async def main():
     return {'message': 'ok'}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.exposition(),
+                             media_type="text/plain; version=0.0.4")
@@ -0,0 +1,360 @@
+"""Request metrics in the Prometheus text format.
+
+`MetricsMiddleware` records per route latency, response size, status,
+in-flight requests and the SQL statements each request ran, counted by
+cursor events on the engines. Counters are plain dicts and ints of the
+worker, only touched from its event loop, so recording takes no lock.
+
+Each uvicorn worker writes its counters to `DATA_DIR/metrics/{pid}.json`
+every `METRICS_INTERVAL` seconds. `/metrics` adds the files of the other
+live workers to the counters of the one serving it.
+"""
+import asyncio
+import bisect
+import contextvars
+import glob
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import event
+
+from src.config import get_settings
+
+settings = get_settings()
+METRICS_DIR = os.path.join(settings.data_dir, "metrics")
+INTERVAL = float(settings.metrics_interval)
+PREFIX = "memo_"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger(__name__)
+
+
+class RequestStats:
+    """SQL run by one request."""
+    __slots__ = ("_route", "scope", "queries", "db_seconds", "shapes")
+
+    def __init__(self, route: str = "", scope=None):
+        self._route = route
+        # Filled in by the router, see `route`
+        self.scope = scope
+        self.queries = 0
+        self.db_seconds = 0.0
+        # Statement counts, kept by `querylog` when detecting N+1
+        self.shapes: dict[str, int] = {}
+
+    @property
+    def route(self) -> str:
+        if self._route or self.scope is None:
+            return self._route
+        return route_label(self.scope)
+
+
+_current: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar(
+    "metrics_request", default=None)
+
+
+def current() -> RequestStats | None:
+    """The stats of the request being served, if any."""
+    return _current.get()
+
+
+class Histogram:
+    """Bucket counts, not cumulative until rendered."""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# name: (help, buckets)
+HISTOGRAMS = {
+    "request_duration_seconds":
+    ("Time until the last byte of the response", LATENCY_BUCKETS),
+    "response_size_bytes": ("Bytes of response body", SIZE_BUCKETS),
+    "db_duration_seconds":
+    ("Time in SQL statements per request", LATENCY_BUCKETS),
+    "db_queries": ("SQL statements per request", QUERY_BUCKETS),
+}
+
+
+class Registry:
+    """The metrics of this worker."""
+
+    def __init__(self):
+        self.requests: dict[tuple[str, str, str], int] = {}
+        self.histograms: dict[str, dict[tuple[str, str], Histogram]] = {
+            name: {}
+            for name in HISTOGRAMS
+        }
+        self.in_flight = 0
+
+    def observe(self, name: str, labels: tuple[str, str], value: float):
+        histograms = self.histograms[name]
+        histogram = histograms.get(labels)
+        if histogram is None:
+            histogram = histograms[labels] = Histogram(HISTOGRAMS[name][1])
+        histogram.observe(value)
+
+    def record(self, method: str, route: str, status: int, seconds: float,
+               size: int, stats: RequestStats):
+        key = (method, route, str(status))
+        self.requests[key] = self.requests.get(key, 0) + 1
+        labels = (method, route)
+        self.observe("request_duration_seconds", labels, seconds)
+        self.observe("response_size_bytes", labels, size)
+        self.observe("db_duration_seconds", labels, stats.db_seconds)
+        self.observe("db_queries", labels, stats.queries)
+
+    def snapshot(self) -> dict:
+        return {
+            "requests": [[*k, v] for k, v in self.requests.items()],
+            "histograms": {
+                name: [[*labels, h.counts, h.sum, h.count]
+                       for labels, h in histograms.items()]
+                for name, histograms in self.histograms.items()
+            },
+            "in_flight": self.in_flight,
+        }
+
+
+registry = Registry()
+
+
+def merge(snapshots: list[dict]) -> dict:
+    """Sum the snapshots of several workers."""
+    requests: dict[tuple, int] = {}
+    histograms: dict[str, dict[tuple, list]] = {}
+    in_flight = 0
+    for snapshot in snapshots:
+        in_flight += snapshot["in_flight"]
+        for *key, value in snapshot["requests"]:
+            requests[tuple(key)] = requests.get(tuple(key), 0) + value
+        for name, rows in snapshot["histograms"].items():
+            merged = histograms.setdefault(name, {})
+            for method, route, counts, total, count in rows:
+                row = merged.get((method, route))
+                if row is None:
+                    merged[(method, route)] = [list(counts), total, count]
+                    continue
+                row[0] = [a + b for a, b in zip(row[0], counts)]
+                row[1] += total
+                row[2] += count
+    return {
+        "requests": requests,
+        "histograms": histograms,
+        "in_flight": in_flight
+    }
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render(merged: dict) -> str:
+    lines = [
+        f"# HELP {PREFIX}requests_in_flight Requests being served",
+        f"# TYPE {PREFIX}requests_in_flight gauge",
+        f"{PREFIX}requests_in_flight {merged['in_flight']}",
+        f"# HELP {PREFIX}requests_total Responses by route and status",
+        f"# TYPE {PREFIX}requests_total counter",
+    ]
+    for (method, route, code), value in sorted(merged["requests"].items()):
+        lines.append(f'{PREFIX}requests_total{{method="{method}",'
+                     f'route="{escape(route)}",status="{code}"}} {value}')
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        metric = PREFIX + name
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} histogram")
+        rows = merged["histograms"].get(name, {})
+        for (method, route), (counts, total, count) in sorted(rows.items()):
+            labels = f'method="{method}",route="{escape(route)}"'
+            cumulative = 0
+            for bound, n in zip((*buckets, "+Inf"), counts):
+                cumulative += n
+                lines.append(
+                    f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum{{{labels}}} {total}")
+            lines.append(f"{metric}_count{{{labels}}} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot_path() -> str:
+    return os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+
+
+def write_snapshot():
+    """Publish this worker's metrics for the others to read."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = snapshot_path()
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp, path)
+
+
+def read_snapshots() -> list[dict]:
+    """This worker's live counters and the snapshots of the others."""
+    snapshots = [registry.snapshot()]
+    if INTERVAL <= 0:
+        return snapshots
+    own = snapshot_path()
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        if path == own:
+            continue
+        # A worker that went away starts from zero again, as counters
+        # of a restarted process do
+        if not pid_alive(int(os.path.basename(path).split(".")[0])):
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def exposition() -> str:
+    """The `/metrics` body, summed over all workers."""
+    return render(merge(read_snapshots()))
+
+
+# endpoint -> path of routes that don't put themselves in the scope
+_endpoint_paths: dict = {}
+
+
+def route_label(scope) -> str:
+    """The path template of the route the router picked, which keeps
+    the number of label values bounded.
+
+    Read from the scope once routing is done, FastAPI routes add
+    themselves, other routes only their endpoint.
+    """
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "<unmatched>"
+    path = _endpoint_paths.get(endpoint)
+    if path is None:
+        path = "<unmatched>"
+        for route in getattr(scope.get("app"), "routes", ()):
+            if getattr(route, "endpoint", None) is endpoint:
+                path = route.path
+                break
+        _endpoint_paths[endpoint] = path
+    return path
+
+
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(scope=scope)
+        token = _current.set(stats)
+        status = 500
+        size = 0
+        elapsed = None
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status, size, elapsed
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    elapsed = time.perf_counter() - start
+            await send(message)
+
+        registry.in_flight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            registry.in_flight -= 1
+            _current.reset(token)
+            if elapsed is None:
+                elapsed = time.perf_counter() - start
+            registry.record(scope["method"], stats.route, status, elapsed,
+                            size, stats)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info["metrics_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += time.perf_counter() - conn.info["metrics_start"]
+
+
+def instrument(engine):
+    """Count the statements of `engine` towards the current request."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+async def run_forever(interval: float = INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            write_snapshot()
+        except OSError:
+            logger.exception("writing metrics failed")
+
+
+_task: asyncio.Task | None = None
+
+
+def start():
+    """Publish this worker's metrics periodically unless disabled."""
+    global _task
+    if INTERVAL > 0 and _task is None:
+        _task = asyncio.create_task(run_forever())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    try:
+        os.remove(snapshot_path())
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,146 @@
+"""Versioned changes to existing databases.
+
+`Base.metadata.create_all` creates missing tables with their indexes,
+but never changes a table that exists. Those changes are numbered
+migrations here, applied in order and recorded in `schema_version`. Run
+once after upgrading, from `server/`:
+
+    python -m src.migrate
+
+Migrations are idempotent, so they also run cleanly on databases that
+`create_all` made after them. On Postgres indexes are built
+`CONCURRENTLY`, without blocking writes. A failed concurrent build
+leaves an invalid index behind, drop it and run the migration again.
+"""
+import argparse
+import logging
+import time
+from typing import Callable
+
+from sqlalchemy import Index, delete, func, insert, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from src import crud
+from src.database import (TEXT_SEARCH_INDEX, Base, SchemaVersion,
+                          UserStatistics, engine)
+
+logger = logging.getLogger(__name__)
+
+
+def get_index(name: str) -> Index:
+    for table in Base.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(name)
+
+
+def create_index_sql(conn: Connection, sql: str):
+    if conn.dialect.name == "postgresql":
+        sql = sql.replace(" INDEX ", " INDEX CONCURRENTLY ", 1)
+    conn.exec_driver_sql(sql)
+
+
+def create_index(conn: Connection, index: Index):
+    create_index_sql(
+        conn,
+        str(
+            CreateIndex(index,
+                        if_not_exists=True).compile(dialect=conn.dialect)))
+
+
+# Tables of the last release before migrations, which had no indexes
+# but the primary keys and `users.name`. Tables added since come with
+# their indexes from `create_all`.
+RELEASED_TABLES = ("users", "user_statistics", "items", "images")
+
+
+def create_released_tables(conn: Connection):
+    """The schema of the last release before migrations, for tests and
+    `benchmarks.query_plans`."""
+    for name in RELEASED_TABLES:
+        conn.execute(CreateTable(Base.metadata.tables[name]))
+
+
+def dedupe_user_statistics(conn: Connection):
+    """Keep the first statistics row of each user and recount it."""
+    users = conn.scalars(
+        select(UserStatistics.user_id).group_by(
+            UserStatistics.user_id).having(func.count() > 1)).all()
+    if not users:
+        return
+    first = select(func.min(UserStatistics.id)).group_by(
+        UserStatistics.user_id)
+    conn.execute(
+        delete(UserStatistics).where(UserStatistics.user_id.in_(users),
+                                     UserStatistics.id.not_in(first)))
+    conn.execute(crud.recount_user_statistics(users))
+    logger.info("merged duplicate statistics of %d users", len(users))
+
+
+# The indexes `src.database` declares on the released tables
+HOT_INDEXES = ("ix_items_live", "ix_items_recycled", "ix_items_owner_updated",
+               "ix_items_expired", "ix_images_item", "ix_images_live_owner",
+               "ix_images_data", "ix_images_expired",
+               "ix_user_statistics_user_id")
+
+
+def add_hot_indexes(conn: Connection):
+    # The unique index cannot be built over duplicates
+    dedupe_user_statistics(conn)
+    for name in HOT_INDEXES:
+        create_index(conn, get_index(name))
+    # Full-text search of `crud.search_items`, other databases use the
+    # `search_terms` table
+    if conn.dialect.name == "postgresql":
+        create_index_sql(conn, TEXT_SEARCH_INDEX.statement)
+
+
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "indexes for the hot filter and text search columns", add_hot_indexes),
+]
+
+
+def current_version(conn: Connection) -> int:
+    return conn.scalar(select(func.max(SchemaVersion.version))) or 0
+
+
+def upgrade(bind: Engine = engine) -> list[int]:
+    """Apply the pending migrations, return their versions."""
+    Base.metadata.create_all(bind=bind)
+    applied = []
+    # Concurrent index builds cannot run inside a transaction
+    options = ({
+        "isolation_level": "AUTOCOMMIT"
+    } if bind.dialect.name == "postgresql" else {})
+    with bind.connect().execution_options(**options) as conn:
+        version = current_version(conn)
+        for number, description, migration in MIGRATIONS:
+            if number <= version:
+                continue
+            logger.info("migration %d: %s", number, description)
+            with conn.begin():
+                migration(conn)
+                conn.execute(
+                    insert(SchemaVersion).values(version=number,
+                                                 applied_at=crud.get_time()))
+            applied.append(number)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Apply pending schema migrations.")
+    parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    applied = upgrade()
+    with engine.connect() as conn:
+        version = current_version(conn)
+    print(f"applied {applied or 'nothing'}, schema version {version} "
+          f"({time.perf_counter() - start:.1f} s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Hard delete items and images that stayed in the recycle bin past the
+retention period.
+
+Runs inside the app every `PURGE_INTERVAL` seconds, or once from the
+command line:
+
+    python -m src.purge --retention-days 30 --batch-size 500
+
+Each batch is its own transaction, so a long purge never holds locks
+for long and can be interrupted at any point.
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from src import crud
+from src.config import get_settings
+from src.database import AsyncSessionLocal
+
+settings = get_settings()
+RETENTION_DAYS = float(settings.purge_retention_days)
+BATCH_SIZE = int(settings.purge_batch_size)
+INTERVAL = float(settings.purge_interval)
+DAY_MS = 24 * 60 * 60 * 1000
+
+logger = logging.getLogger(__name__)
+
+
+class PurgeStats:
+    """What one purge run removed and how fast."""
+
+    def __init__(self):
+        self.batches = 0
+        self.items = 0
+        self.images = 0
+        self.files = 0
+        self.seconds = 0.0
+
+    def add(self, items: int, images: int, files: int):
+        self.batches += 1
+        self.items += items
+        self.images += images
+        self.files += files
+
+    @property
+    def rows_per_second(self) -> float:
+        rows = self.items + self.images
+        return rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (f"purged {self.items} items, {self.images} images and "
+                f"{self.files} files in {self.batches} batches, "
+                f"{self.seconds:.2f} s ({self.rows_per_second:.0f} rows/s)")
+
+
+async def purge(retention_days: float = RETENTION_DAYS,
+                batch_size: int = BATCH_SIZE,
+                now: int | None = None) -> PurgeStats:
+    """Purge everything soft deleted more than `retention_days` ago."""
+    before = (now or crud.get_time()) - int(retention_days * DAY_MS)
+    stats = PurgeStats()
+    start = time.perf_counter()
+    while True:
+        async with AsyncSessionLocal() as db:
+            removed = await crud.purge_expired(db, before, batch_size)
+        if removed is None:
+            # Raced with another purge, pick a fresh batch
+            continue
+        if removed == (0, 0, 0):
+            break
+        stats.add(*removed)
+    stats.seconds = time.perf_counter() - start
+    if stats.batches:
+        logger.info("%s", stats)
+    return stats
+
+
+async def run_forever(interval: float = INTERVAL):
+    while True:
+        try:
+            await purge()
+        except Exception:
+            logger.exception("purge failed")
+        await asyncio.sleep(interval)
+
+
+_task: asyncio.Task | None = None
+
+
+def start():
+    """Schedule periodic purges on the running loop unless disabled."""
+    global _task
+    if INTERVAL > 0 and _task is None:
+        _task = asyncio.create_task(run_forever())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Hard delete expired items and images.")
+    parser.add_argument("--retention-days", type=float, default=RETENTION_DAYS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(asyncio.run(purge(args.retention_days, args.batch_size)))
+
+
+if __name__ == "__main__":
+    main()
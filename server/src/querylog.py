@@ -0,0 +1,112 @@
+"""Slow-query log and N+1 detector, both opt-in.
+
+With `SLOW_QUERY_MS` above 0 every statement is timed by cursor events,
+and those slower than that are logged with the route of the request
+that ran them and the types of their bound parameters. The values hold
+password hashes and memo text, `LOG_QUERY_PARAMS=true` logs them too.
+`EXPLAIN_SLOW_QUERIES=true` adds the plan of slow `SELECT`s, at the cost
+of running `EXPLAIN` on the same connection.
+
+In the `dev` stage a request that runs one statement shape more than
+`N_PLUS_ONE_THRESHOLD` times logs a warning, which is what a loop of
+lazy loads looks like. Shapes ignore how many values an `IN (...)` has.
+"""
+import logging
+import re
+import reprlib
+import time
+
+from sqlalchemy import event
+
+from src import metrics
+from src.config import get_settings
+
+settings = get_settings()
+SLOW_QUERY_MS = float(settings.slow_query_ms)
+EXPLAIN = settings.explain_slow_queries.lower() in ("1", "true", "yes")
+LOG_PARAMS = settings.log_query_params.lower() in ("1", "true", "yes")
+N_PLUS_ONE_THRESHOLD = int(settings.n_plus_one_threshold)
+DETECT_N_PLUS_ONE = settings.stage == "dev" and N_PLUS_ONE_THRESHOLD > 0
+
+logger = logging.getLogger(__name__)
+
+_PARAM = r"(?:\?|\$\d+|%\(\w+\)s|%s|:\w+)"
+_PARAM_LIST = re.compile(rf"\(\s*{_PARAM}(?:\s*,\s*{_PARAM})*\s*\)")
+_params_repr = reprlib.Repr()
+_params_repr.maxstring = 80
+_params_repr.maxother = 80
+_params_repr.maxlist = _params_repr.maxtuple = 20
+MAX_PARAMS = 20
+
+
+def shape(statement: str) -> str:
+    """`statement` with parameter lists collapsed to `(...)`."""
+    return _PARAM_LIST.sub("(...)", statement)
+
+
+def describe(parameters, executemany: bool = False) -> str:
+    """Names and types of bound parameters, without their values."""
+    if executemany:
+        first = describe(parameters[0]) if parameters else ""
+        return f"{len(parameters)} x {first}"
+    if isinstance(parameters, dict):
+        items = [f"{k}: {type(v).__name__}" for k, v in parameters.items()]
+    else:
+        items = [type(v).__name__ for v in parameters or ()]
+    if len(items) > MAX_PARAMS:
+        items[MAX_PARAMS:] = ["..."]
+    return "(" + ", ".join(items) + ")"
+
+
+def explain(conn, statement: str, parameters) -> str:
+    """The plan of `statement`, run on a cursor of its own so it does
+    not fire the events again."""
+    prefix = ("EXPLAIN QUERY PLAN "
+              if conn.dialect.name == "sqlite" else "EXPLAIN ")
+    plan_cursor = conn.connection.cursor()
+    try:
+        plan_cursor.execute(prefix + statement, parameters)
+        return "\n".join(" ".join(str(col) for col in row)
+                         for row in plan_cursor.fetchall())
+    except Exception as e:
+        return f"EXPLAIN failed: {e}"
+    finally:
+        plan_cursor.close()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info["querylog_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    ms = (time.perf_counter() - conn.info["querylog_start"]) * 1000
+    stats = metrics.current()
+    route = stats.route if stats is not None else "-"
+    if 0 < SLOW_QUERY_MS <= ms:
+        plan = ""
+        is_select = statement.lstrip()[:6].upper() == "SELECT"
+        if EXPLAIN and is_select and not executemany:
+            plan = "\n" + explain(conn, statement, parameters)
+        if LOG_PARAMS:
+            params = _params_repr.repr(parameters)
+        else:
+            params = describe(parameters, executemany)
+        logger.warning("Slow query %.1f ms on %s: %s\nparams: %s%s", ms, route,
+                       statement, params, plan)
+    if DETECT_N_PLUS_ONE and stats is not None:
+        key = shape(statement)
+        count = stats.shapes.get(key, 0) + 1
+        stats.shapes[key] = count
+        if count == N_PLUS_ONE_THRESHOLD + 1:
+            logger.warning("Possible N+1 on %s: statement ran %d times: %s",
+                           route, count, key)
+
+
+def instrument(engine):
+    """Log slow statements of `engine` and detect N+1, when enabled."""
+    if SLOW_QUERY_MS <= 0 and not DETECT_N_PLUS_ONE:
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
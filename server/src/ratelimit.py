@@ -0,0 +1,129 @@
+"""Sliding-window rate limits as FastAPI dependencies.
+
+With Redis the window of each key is a sorted set of request times,
+trimmed, counted and appended by one Lua script, so a check costs one
+round trip and concurrent workers share the count. Without Redis, or
+when it errors, each worker keeps its own windows in memory.
+
+Limits are per client address or per user, so a burst from one of them
+only locks out that one.
+"""
+import threading
+import time
+import uuid
+from collections import deque
+
+import redis
+from fastapi import Depends, HTTPException, Request, status
+from redis import asyncio as aioredis
+
+from src import schemas
+from src.cache import TTLCache
+from src.config import get_settings
+from src.database import get_redis
+from src.routers.user import get_current_user
+
+settings = get_settings()
+KEY_PREFIX = "ratelimit:"
+LOCAL_KEYS = 10000
+
+# KEYS[1]: the window, ARGV: limit, window in ms, unique member.
+# Returns 0 if the request is allowed, else ms until a slot frees up.
+# Rejected requests are not recorded, so retrying after that works.
+SLIDING_WINDOW = """
+local now = redis.call('TIME')
+local now_ms = now[1] * 1000 + math.floor(now[2] / 1000)
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms - window)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('ZADD', KEYS[1], now_ms, ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return 0
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return tonumber(oldest[2]) + window - now_ms
+"""
+
+
+def parse_rate(rate: str) -> tuple[int, float]:
+    """`"10/60"` is 10 requests per 60 seconds, a limit of 0 disables."""
+    limit, seconds = rate.split("/")
+    return int(limit), float(seconds)
+
+
+class RateLimit:
+    """At most `limit` requests per `window` seconds from one client
+    address."""
+
+    def __init__(self, name: str, rate: str):
+        self.name = name
+        self.limit, self.window = parse_rate(rate)
+        self._local = TTLCache(LOCAL_KEYS, self.window)
+        self._lock = threading.Lock()
+        self._script = None
+
+    def retry_after_local(self, key: str) -> float:
+        now = time.monotonic()
+        with self._lock:
+            hits = self._local.get(key)
+            if hits is None:
+                hits = deque()
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+            if len(hits) >= self.limit:
+                return hits[0] + self.window - now
+            hits.append(now)
+            self._local.set(key, hits)
+            return 0
+
+    async def retry_after(self, key: str,
+                          redis_client: aioredis.Redis | None) -> float:
+        """Record a request, return seconds to wait if it is over the
+        limit."""
+        if redis_client is not None:
+            if self._script is None:
+                self._script = redis_client.register_script(SLIDING_WINDOW)
+            try:
+                wait_ms = await self._script(
+                    keys=[f"{KEY_PREFIX}{self.name}:{key}"],
+                    args=[
+                        self.limit,
+                        int(self.window * 1000),
+                        uuid.uuid4().hex
+                    ],
+                    client=redis_client)
+                return int(wait_ms) / 1000
+            except redis.RedisError:
+                pass
+        return self.retry_after_local(key)
+
+    async def check(self, key: str, redis_client: aioredis.Redis | None):
+        """Raises 429 with `Retry-After` when `key` is over the limit."""
+        if self.limit <= 0:
+            return
+        wait = await self.retry_after(key, redis_client)
+        if wait > 0:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers={"Retry-After": str(max(1, round(wait)))})
+
+    async def __call__(self, request: Request,
+                       redis_client=Depends(get_redis)):
+        host = request.client.host if request.client else "unknown"
+        await self.check(host, redis_client)
+
+
+class UserRateLimit(RateLimit):
+    """At most `limit` requests per `window` seconds from one user."""
+
+    async def __call__(  # type: ignore
+        self,
+        redis_client=Depends(get_redis),
+        current_user: schemas.CurrentUser = Depends(get_current_user)):
+        await self.check(str(current_user.id), redis_client)
+
+
+login_limit = RateLimit("login", settings.login_rate_limit)
+register_limit = RateLimit("register", settings.register_rate_limit)
+upload_limit = UserRateLimit("upload", settings.upload_rate_limit)
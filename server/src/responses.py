@@ -0,0 +1,29 @@
+"""JSON responses that skip `response_model` validation.
+
+Endpoints returning data they loaded themselves build plain dicts and
+return a `FastJSONResponse`, which FastAPI sends as is. orjson encodes
+them when installed, the stdlib `json` otherwise.
+"""
+import json
+from typing import Any
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False,
+                      separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -3,13 +3,15 @@ from datetime import datetime, timedelta
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from jose import jwt
-from sqlalchemy.orm import Session
-from src import crud, schemas
+from sqlalchemy.ext.asyncio import AsyncSession
+from src import crud, hashing, schemas
 from src.config import get_settings
-from src.database import get_db
+from src.database import get_async_db
+from src.ratelimit import login_limit, register_limit
 
 router = APIRouter(prefix='/api/v1/auth', tags=['auth'])
 ACCESS_TOKEN_EXPIRE_DAYS = int(get_settings().access_token_expire_days)
+RETRY_AFTER = 1  # seconds
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -32,20 +34,38 @@ credentials_exception = HTTPException(
     headers={"WWW-Authenticate": "Bearer"},
 )
 
+busy_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Too many login attempts in progress",
+    headers={"Retry-After": str(RETRY_AFTER)},
+)
+
 
-@router.post("/register", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_name(db, name=user.name)
+@router.post("/register",
+             response_model=schemas.User,
+             dependencies=[Depends(register_limit)])
+async def create_user(user: schemas.UserCreate,
+                      db: AsyncSession = Depends(get_async_db)):
+    db_user = await crud.get_user_by_name(db, name=user.name)
     if db_user:
         raise HTTPException(status_code=400, detail="Name already registered")
-    return crud.create_user(db=db, user=user)
+    try:
+        return await crud.create_user(db=db, user=user)
+    except hashing.HashQueueFull:
+        raise busy_exception
 
 
-@router.post("/login", response_model=schemas.Token)
+@router.post("/login",
+             response_model=schemas.Token,
+             dependencies=[Depends(login_limit)])
 async def login_for_access_token(
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         form_data: OAuth2PasswordRequestForm = Depends()):
-    user = crud.authenticate_user(db, form_data.username, form_data.password)
+    try:
+        user = await crud.authenticate_user(db, form_data.username,
+                                            form_data.password)
+    except hashing.HashQueueFull:
+        raise busy_exception
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
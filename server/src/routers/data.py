@@ -1,25 +1,114 @@
+import hashlib
 import os
+from email.utils import formatdate, parsedate_to_datetime
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from fastapi.responses import FileResponse
-from src import crud
+from sqlalchemy.ext.asyncio import AsyncSession
+from src import cache, crud, thumbnail
 from src.config import get_settings
-from src.database import SessionLocal, get_db
+from src.database import get_async_db
 
-DATA_DIR = get_settings().data_dir
+settings = get_settings()
+DATA_DIR = settings.data_dir
+FILE_SERVING = settings.file_serving
+ACCEL_REDIRECT_PREFIX = settings.accel_redirect_prefix.rstrip('/')
+# Stored names are content hashes, so a file never changes
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
 router = APIRouter(
     prefix='/data',
     tags=['file'],
-    dependencies=[Depends(get_db)],
+    dependencies=[Depends(get_async_db)],
 )
 
 
-# Files not authenticated for easy development
-# Use S3 or other cloud storage for production
+def image_etag(name: str, size: str | None) -> str:
+    """Strong ETag derived from the stored name of the file."""
+    digest = hashlib.sha1(f"{name}:{size or ''}".encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def is_not_modified(request: Request, etag: str,
+                    created_at: int | None) -> bool:
+    """Evaluate `If-None-Match`, then `If-Modified-Since`."""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [t.strip().removeprefix('W/') for t in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is None or created_at is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return created_at // 1000 <= since
+
+
+def send_file(path: str, media_type: str, headers: dict) -> Response:
+    """Serve a file under `DATA_DIR` as configured by `FILE_SERVING`.
+
+    In `nginx` mode the response has no body, nginx streams the file
+    from the internal `ACCEL_REDIRECT_PREFIX` location with sendfile.
+    """
+    if FILE_SERVING == 'nginx':
+        name = os.path.relpath(path, DATA_DIR)
+        headers['X-Accel-Redirect'] = f'{ACCEL_REDIRECT_PREFIX}/{name}'
+        return Response(headers=headers, media_type=media_type)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+async def lookup_image(db: AsyncSession,
+                       image_id: int) -> tuple[str, str, int | None] | None:
+    """`(stored name, file type, created_at)` of an image, cached.
+
+    `None` if the image or its file is gone. Other workers and the purge
+    delete images without reaching this worker's cache, so a cached
+    entry whose file is missing is dropped and looked up again.
+    """
+    entry = cache.image_cache.get(image_id)
+    if entry is not None:
+        if os.path.exists(os.path.join(DATA_DIR, entry[0])):
+            return entry
+        cache.image_cache.delete(image_id)
+    db_img = await crud.get_image(db, image_id)
+    if not db_img or not os.path.exists(os.path.join(DATA_DIR, db_img.data)):
+        return None
+    entry = (db_img.data, db_img.file_type, db_img.created_at)
+    cache.image_cache.set(image_id, entry)
+    return entry
+
+
+# Not authenticated: the frontend loads images with `<img src>`, which
+# sends no bearer token, and responses are cached as `public`. Checking
+# access needs cookie or signed URL auth first. In both serving modes
+# only image ids are reachable, the nginx location is `internal`.
 @router.get("/{image_id}", response_class=FileResponse)
-async def get_image(image_id: int, db: SessionLocal = Depends(get_db)):
-    db_img = crud.get_image(db, image_id)
-    if not db_img:
+async def get_image(request: Request,
+                    image_id: int,
+                    size: str | None = None,
+                    db: AsyncSession = Depends(get_async_db)):
+    """Serve an image, or its resized variant with `size=thumb|medium`.
+
+    Conditional requests are answered with 304 before touching the disk.
+    """
+    if size is not None and size not in thumbnail.SIZES:
+        raise HTTPException(status_code=400, detail=f"Unknown size {size}")
+    entry = await lookup_image(db, image_id)
+    if entry is None:
         raise HTTPException(status_code=404)
-    return FileResponse(os.path.join(DATA_DIR, db_img.data),
-                        media_type=db_img.file_type)
+    name, file_type, created_at = entry
+    headers = {
+        'Cache-Control': CACHE_CONTROL,
+        'ETag': image_etag(name, size),
+    }
+    if created_at is not None:
+        headers['Last-Modified'] = formatdate(created_at / 1000, usegmt=True)
+    if is_not_modified(request, headers['ETag'], created_at):
+        return Response(status_code=304, headers=headers)
+    if size is not None:
+        variant = await thumbnail.get_variant(name, size)
+        if variant is not None:
+            path, media_type = variant
+            return send_file(path, media_type, headers)
+    return send_file(os.path.join(DATA_DIR, name), file_type, headers)
@@ -1,156 +1,347 @@
-import os
-import time
-import uuid
-
-import aiofiles  # type: ignore
-from fastapi import APIRouter, Depends, Form, HTTPException, UploadFile
-from sqlalchemy.orm import Session
-from src import crud, schemas
+from fastapi import (APIRouter, BackgroundTasks, Depends, HTTPException, Query,
+                     Request, Response)
+from sqlalchemy.ext.asyncio import AsyncSession
+from src import cache, crud, purge, schemas, thumbnail
+from src.upload import receive_form
 from src.config import get_settings
-from src.database import get_db
+from src.database import get_async_db, get_redis
+from src.ratelimit import upload_limit
+from src.responses import FastJSONResponse, dumps
 from src.routers.user import get_current_user
 
 router = APIRouter(
     prefix='/api/v1/item',
     tags=['item'],
-    dependencies=[Depends(get_db), Depends(get_current_user)],
+    dependencies=[Depends(get_async_db),
+                  Depends(get_current_user)],
 )
-DATA_DIR = get_settings().data_dir
 STAGE = get_settings().stage
-CHUNK_SIZE = 1024 * 1024 * 5  # 5 MB
+PAGE_SIZE = 10
+CHANGES_PAGE_SIZE = 100
+# Changes newer than this are left for the next sync, so a transaction
+# that commits late cannot end up below the high-water mark.
+SYNC_LAG_MS = 1000
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
 
 
-async def save_file(user: schemas.User, file: UploadFile):
-    """Save file to disk and return filename.
-   
-    Files are saved in `{DATA_DIR}/{user}/{ymd}/{filename}`.
-    Relative path `{user}/{ymd}/{filename}` is saved in database.
-    """
-
-    random_hex = uuid.uuid4().hex
-    ext = file.filename.split('.')[-1]
-    name = f"{user.name}/{time.strftime('%y%m%d')}/{random_hex}.{ext}"
-    path = f"{DATA_DIR}/{name}"
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    async with aiofiles.open(path, 'wb') as f:
-        while chunk := await file.read(CHUNK_SIZE):
-            await f.write(chunk)
-
-    return name
-
-
-async def save_file_paths(current_user, images: list[UploadFile]) -> list[str]:
-    """Save file to disk and return paths"""
-    paths = []
-    if images:
-        for image in images:
-            path = await save_file(current_user, image)
-            paths.append(path)
-    return paths
+def image_url(image_id: int) -> str:
+    if STAGE == 'dev':
+        return f'http://localhost:8000/data/{image_id}'
+    return f'/data/{image_id}'
 
 
 def parse_images(images):
     for img in images:
-        if STAGE == 'dev':
-            img.data = f'http://localhost:8000/data/{img.id}'
-            img.thumbnail = f'http://localhost:8000/data/{img.id}'
-        else:
-            img.data = f'/data/{img.id}'
-            img.thumbnail = f'/data/{img.id}'
+        img.data = image_url(img.id)
+        img.thumbnail = f'{img.data}?size=thumb'
     return images
 
 
+def item_dict(item) -> dict:
+    """`schemas.Item` of a loaded item as a plain dict, without
+    validating what came from our own database."""
+    images = []
+    for img in item.images:
+        data = image_url(img.id)
+        images.append({
+            'id': img.id,
+            'data': data,
+            'thumbnail': f'{data}?size=thumb',
+            'item_id': img.item_id,
+            'deleted_at': img.deleted_at,
+        })
+    return {
+        'id': item.id,
+        'text': item.text,
+        'owner_id': item.owner_id,
+        'created_time': item.created_time,
+        'updated_time': item.updated_time,
+        'images': images,
+        'deleted_at': item.deleted_at,
+    }
+
+
 @router.get("/", response_model=schemas.Item)
-async def read_one_item(id: int,
-                        db: Session = Depends(get_db),
-                        current_user: schemas.User = Depends(get_current_user)):
-    verify = crud.verify_item(db, current_user.id, id)
-    if verify == False:
+async def read_one_item(
+    id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.CurrentUser = Depends(get_current_user)):
+    item = await crud.get_owned_item(db, current_user.id, id)
+    if item is False:
         raise HTTPException(status_code=400, detail="Not authorized")
-    elif verify is None:
+    elif item is None:
         raise HTTPException(status_code=404, detail="Item not found")
-    item = crud.get_item(db, id)
-    item.images = parse_images(item.images)  # type: ignore
-    return item
+    return FastJSONResponse(item_dict(item))
+
+
+def set_next_cursor(response: Response, db_items: list, sort_key: str):
+    """Expose the keyset cursor of the next page in a response header."""
+    cursor = crud.next_cursor(db_items, PAGE_SIZE, sort_key)
+    if cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
+
+
+def serialize_page(db_items: list) -> str:
+    """`[item, ...]` as JSON, with the next cursor on the first line."""
+    cursor = crud.next_cursor(db_items, PAGE_SIZE, 'created_time') or ''
+    body = dumps([item_dict(item) for item in db_items]).decode()
+    return f'{cursor}\n{body}'
+
+
+def page_response(page: str) -> Response:
+    cursor, body = page.split('\n', 1)
+    headers = {NEXT_CURSOR_HEADER: cursor} if cursor else None
+    return Response(content=body,
+                    media_type=FastJSONResponse.media_type,
+                    headers=headers)
 
 
 @router.get("/list", response_model=list[schemas.Item])
 async def read_own_items(
     offset: int = 0,
-    db: Session = Depends(get_db),
-    current_user: schemas.User = Depends(get_current_user)):
-    db_items = crud.get_user_items(db, current_user.id, offset, limit=10)
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
+    redis_client=Depends(get_redis),
+    current_user: schemas.CurrentUser = Depends(get_current_user)):
+    """Page through items, newest first.
+
+    Pass the `X-Next-Cursor` header of the previous page as `cursor`.
+    `offset` is still accepted for older clients.
+    Serialized pages are cached until the user changes an item.
+    """
+    key = cursor if cursor is not None else f'offset={offset}'
+    version = await cache.get_list_version(current_user.id, redis_client)
+    page = await cache.get_cached_page(current_user.id, version, key,
+                                       redis_client)
+    if page is not None:
+        return page_response(page)
+    try:
+        db_items = await crud.get_user_items(db,
+                                             current_user.id,
+                                             offset,
+                                             limit=PAGE_SIZE,
+                                             cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    page = serialize_page(db_items)
+    await cache.set_cached_page(current_user.id, version, key, page,
+                                redis_client)
+    return page_response(page)
+
+
+def form_body(files_field: str, **fields) -> dict:
+    """OpenAPI request body of a form parsed by `receive_form`."""
+    properties = {
+        files_field: {
+            "type": "array",
+            "items": {
+                "type": "string",
+                "format": "binary"
+            }
+        },
+        **fields,
+    }
+    return {
+        "requestBody": {
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "properties": properties
+                    }
+                }
+            }
+        }
+    }
+
+
+@router.get("/search", response_model=list[schemas.Item])
+async def search_items(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.CurrentUser = Depends(get_current_user)):
+    """Items containing every word of `q`, best match first.
+
+    Paginated with the `X-Next-Cursor` header like `/list`.
+    """
+    try:
+        db_items = await crud.search_items(db,
+                                           current_user.id,
+                                           q,
+                                           limit=PAGE_SIZE,
+                                           cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     for item in db_items:
         item.images = parse_images(item.images)
+    set_next_cursor(response, db_items, 'search_rank')
     return db_items
 
 
-@router.post("/", response_model=schemas.Item)
-async def create_item(text: str = Form(''),
-                      images: list[UploadFile] | None = None,
-                      db: Session = Depends(get_db),
-                      current_user: schemas.User = Depends(get_current_user)):
-    if images:
-        paths = await save_file_paths(current_user, images)
-        file_types = [image.content_type for image in images]
-    else:
-        paths = []
-        file_types = []
-    db_items = crud.create_user_item(db, current_user.id, text, paths,
-                                     file_types)
+@router.post("/",
+             response_model=schemas.Item,
+             dependencies=[Depends(upload_limit)],
+             openapi_extra=form_body('images', text={"type": "string"}))
+async def create_item(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
+    redis_client=Depends(get_redis),
+    current_user: schemas.CurrentUser = Depends(get_current_user)):
+    """Create an item from the form fields `text` and `images`.
+
+    Images are written to disk while the body is received.
+    """
+    async with receive_form(request, db) as form:
+        images = form.get_files('images')
+        paths = [f.name for f in images]
+        db_items = await crud.create_user_item(
+            db, current_user.id, form.get('text'), paths,
+            [f.content_type for f in images], redis_client)
+    background_tasks.add_task(thumbnail.render_all, paths)
     db_items.images = parse_images(db_items.images)
     return db_items
 
 
 @router.delete("/{id}", response_model=int)
-async def delete_item(id: int,
-                      db: Session = Depends(get_db),
-                      current_user: schemas.User = Depends(get_current_user)):
-    item = crud.delete_user_item(db, id, current_user.id)
+async def delete_item(
+    id: int,
+    db: AsyncSession = Depends(get_async_db),
+    redis_client=Depends(get_redis),
+    current_user: schemas.CurrentUser = Depends(get_current_user)):
+    item = await crud.delete_user_item(db, id, current_user.id, redis_client)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
 
     return item.id
 
 
-@router.put("/{id}", response_model=schemas.Item)
-async def edit_item(id: int,
-                    text: str = Form(''),
-                    delete: list[int] = Form([]),
-                    add: list[UploadFile] | None = None,
-                    db: Session = Depends(get_db),
-                    current_user: schemas.User = Depends(get_current_user)):
-    if add:
-        paths = await save_file_paths(current_user, add)
-        file_types = [image.content_type for image in add]
-    else:
-        paths = []
-        file_types = []
-    item = crud.update_user_item(db, current_user.id, id, text, delete, paths,
-                                 file_types)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
+@router.put("/{id}",
+            response_model=schemas.Item,
+            dependencies=[Depends(upload_limit)],
+            openapi_extra=form_body('add',
+                                    text={"type": "string"},
+                                    delete={
+                                        "type": "array",
+                                        "items": {
+                                            "type": "integer"
+                                        }
+                                    }))
+async def edit_item(
+    id: int,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db),
+    redis_client=Depends(get_redis),
+    current_user: schemas.CurrentUser = Depends(get_current_user)):
+    """Set the `text`, soft delete the image ids in `delete` and add the
+    files in `add`."""
+    async with receive_form(request, db) as form:
+        try:
+            delete = [int(i) for i in form.get_list('delete')]
+        except ValueError:
+            raise HTTPException(status_code=422,
+                                detail="delete must be image ids")
+        add = form.get_files('add')
+        paths = [f.name for f in add]
+        item = await crud.update_user_item(db, current_user.id, id,
+                                           form.get('text'), delete, paths,
+                                           [f.content_type for f in add],
+                                           redis_client)
+        if not item:
+            raise HTTPException(status_code=404, detail="Item not found")
+    background_tasks.add_task(thumbnail.render_all, paths)
     item.images = parse_images(item.images)
 
     return item
 
 
+@router.post("/batch", response_model=list[schemas.BatchResult])
+async def batch_items(
+    batch: schemas.BatchRequest,
+    db: AsyncSession = Depends(get_async_db),
+    redis_client=Depends(get_redis),
+    current_user: schemas.CurrentUser = Depends(get_current_user)):
+    """Create, delete and restore up to 500 items in one transaction.
+
+    Returns one result per operation, in order. Operations on items that
+    do not exist or are not in the right state fail on their own.
+    """
+    return await crud.batch_items(db, current_user.id, batch.operations,
+                                  redis_client)
+
+
+@router.get("/changes", response_model=schemas.ItemChanges)
+async def read_changes(
+    response: Response,
+    since: int = 0,
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.CurrentUser = Depends(get_current_user)):
+    """Items created, updated, deleted or restored after `since` (ms).
+
+    Live items come with their images, deleted ones as tombstones.
+    """
+    until = crud.get_time() - SYNC_LAG_MS
+    try:
+        db_items = await crud.get_changed_items(db,
+                                                current_user.id,
+                                                since,
+                                                until,
+                                                limit=CHANGES_PAGE_SIZE,
+                                                cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    next_cursor = crud.next_cursor(db_items, CHANGES_PAGE_SIZE, 'updated_time')
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+        # Safe to resume from even if the next page shares the timestamp
+        high_water_mark = db_items[-1].updated_time - 1
+    else:
+        high_water_mark = max(since, until)
+    items, deleted = [], []
+    for item in db_items:
+        if item.deleted_at is None:
+            item.images = parse_images(item.images)
+            items.append(item)
+        else:
+            deleted.append(item)
+    retention_ms = int(purge.RETENTION_DAYS * purge.DAY_MS)
+    return schemas.ItemChanges(items=items,
+                               deleted=deleted,
+                               high_water_mark=high_water_mark,
+                               resync=0 < since < until - retention_ms)
+
+
 @router.get("/recycle", response_model=list[schemas.Item])
 async def read_recycle_items(
     offset: int = 0,
-    db: Session = Depends(get_db),
-    current_user: schemas.User = Depends(get_current_user)):
-    db_items = crud.get_deleted_items(db, current_user.id, offset, limit=10)
-    for item in db_items:
-        item.images = parse_images(item.images)
-    return db_items
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: schemas.CurrentUser = Depends(get_current_user)):
+    """Page through deleted items, paginated like `/list`."""
+    try:
+        db_items = await crud.get_deleted_items(db,
+                                                current_user.id,
+                                                offset,
+                                                limit=PAGE_SIZE,
+                                                cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    response = FastJSONResponse([item_dict(item) for item in db_items])
+    set_next_cursor(response, db_items, 'deleted_at')
+    return response
 
 
 @router.post("/restore/{id}")
-async def restore_item(id: int,
-                       db: Session = Depends(get_db),
-                       current_user: schemas.User = Depends(get_current_user)):
-    item = crud.restore_item(db, id, current_user.id)
+async def restore_item(
+    id: int,
+    db: AsyncSession = Depends(get_async_db),
+    redis_client=Depends(get_redis),
+    current_user: schemas.CurrentUser = Depends(get_current_user)):
+    item = await crud.restore_item(db, id, current_user.id, redis_client)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
     return {"detail": f"Restored item {id}"}
@@ -1,22 +1,25 @@
 import json
-import shutil
-import tempfile
+import os
 import zipfile
-from pathlib import Path
 
+import aiofiles  # type: ignore
 from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
-from src import crud, schemas
+from sqlalchemy.ext.asyncio import AsyncSession
+from src import cache, crud, schemas
 from src.config import get_settings
-from src.database import get_db, oauth2_scheme
+from src.database import get_async_db, get_redis, oauth2_scheme
 
 router = APIRouter(prefix='/api/v1/user', tags=['user'])
+DATA_DIR = get_settings().data_dir
+CHUNK_SIZE = 1024 * 64  # 64 KB
 
 
-async def get_current_user(db: Session = Depends(get_db),
-                           token: str = Depends(oauth2_scheme)):
+async def get_current_user(db: AsyncSession = Depends(get_async_db),
+                           token: str = Depends(oauth2_scheme),
+                           redis_client=Depends(get_redis)):
+    """Resolve the token subject, served from `cache` when possible."""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -32,58 +35,84 @@ async def get_current_user(db: Session = Depends(get_db),
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = crud.get_user_by_name(db, name=username)
-    if user is None:
+    user = await cache.get_cached_user(username, redis_client)
+    if user is not None:
+        return user
+    db_user = await crud.get_user_by_name(db, name=username)
+    if db_user is None:
         raise credentials_exception
+    user = schemas.CurrentUser.from_orm(db_user)
+    await cache.set_cached_user(user, redis_client)
     return user
 
 
 @router.get("/me", response_model=schemas.UserMe)
-async def read_user(db: Session = Depends(get_db),
-                    current_user: schemas.User = Depends(get_current_user)):
-    me = crud.get_me(db, current_user.id)
+async def read_user(
+        db: AsyncSession = Depends(get_async_db),
+        current_user: schemas.CurrentUser = Depends(get_current_user)):
+    me = await crud.get_me(db, current_user.id)
     return me
 
 
-async def get_temp_dir():
-    temp_dir = tempfile.TemporaryDirectory()
-    try:
-        yield temp_dir.name
-    finally:
-        del temp_dir
+class ZipBuffer:
+    """Write-only sink for `zipfile` that hands out what was written."""
 
+    def __init__(self):
+        self._chunks: list[bytes] = []
 
-def zip_dir(dir: str, filename: str):
-    """Zip the provided directory without navigating to 
-        that directory using `pathlib` module
-    """
-    pathobj = Path(dir)
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
 
-    with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for entry in pathobj.rglob("*"):
-            zip_file.write(entry, entry.relative_to(dir))
+
+async def zip_user_data(db: AsyncSession, user: schemas.UserMe):
+    """Yield a zip of the user's items and images as it is built.
+
+    Items go into `{name}/{name}.ndjson`, one JSON object per line.
+    Images are copied from `DATA_DIR` under their stored path.
+    """
+    buffer = ZipBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        with zip_file.open(f"{user.name}/{user.name}.ndjson", "w") as entry:
+            async for items in crud.stream_user_items(db, user.id):
+                for item in items:
+                    entry.write(json.dumps(item.as_dict()).encode() + b"\n")
+                yield buffer.drain()
+        async for paths in crud.stream_user_image_paths(db, user.id):
+            for name in paths:
+                path = os.path.join(DATA_DIR, name)
+                if not os.path.isfile(path):
+                    continue
+                info = zipfile.ZipInfo.from_file(path, name)
+                # Photos are already compressed
+                info.compress_type = zipfile.ZIP_STORED
+                with zip_file.open(info, "w") as entry:
+                    async with aiofiles.open(path, "rb") as f:
+                        while chunk := await f.read(CHUNK_SIZE):
+                            entry.write(chunk)
+                            yield buffer.drain()
+    yield buffer.drain()
 
 
-@router.get("/export", response_class=FileResponse)
-async def export_user(db: Session = Depends(get_db),
-                      current_user: schemas.User = Depends(get_current_user),
-                      temp_dir: str = Depends(get_temp_dir)):
-    """Returns a zip of the user's data."""
-    user = crud.get_me(db, current_user.id)
+@router.get("/export", response_class=StreamingResponse)
+async def export_user(
+        db: AsyncSession = Depends(get_async_db),
+        current_user: schemas.CurrentUser = Depends(get_current_user)):
+    """Stream a zip of the user's data."""
+    user = await crud.get_me(db, current_user.id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    total_items = user.total_items
-    with open(f"{temp_dir}/{user.name}.json", "w") as f:
-        items = crud.get_user_items(db,
-                                    current_user.id,
-                                    offset=0,
-                                    limit=total_items)
-        item_dict = [item.as_dict() for item in items]
-        json.dump({'items': item_dict}, f)
-    s3_folder = f'{BUCKET_PREFIX}/{user.name}'
-    local_folder = f'{temp_dir}/{user.name}'
-    download_s3_folder(s3_folder, local_folder)
-    zip_file = f"{temp_dir}/{user.name}.zip"
-    shutil.move(f"{temp_dir}/{user.name}.json", f"{temp_dir}/{user.name}")
-    shutil.make_archive(zip_file[:-4], 'zip', temp_dir, user.name)
-    return zip_file
+    return StreamingResponse(zip_user_data(db, user),
+                             media_type="application/zip",
+                             headers={
+                                 "Content-Disposition":
+                                 f'attachment; filename="{user.name}.zip"'
+                             })
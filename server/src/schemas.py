@@ -1,5 +1,5 @@
-from pydantic import BaseModel, validator, ConstrainedStr
-from typing import Pattern
+from pydantic import BaseModel, Field, validator, ConstrainedStr
+from typing import Literal, Pattern
 import re
 
 
@@ -78,8 +78,57 @@ class User(UserBase):
         orm_mode = True
 
 
+class CurrentUser(UserBase):
+    """The authenticated user as kept in the user cache."""
+    id: int
+    created_time: int
+
+    class Config:
+        orm_mode = True
+
+
 class UserMe(UserBase):
     id: int
     total_items: int = 0
     total_images: int = 0
-    created_time: int
\ No newline at end of file
+    created_time: int
+
+
+class BatchOperation(BaseModel):
+    """`create` takes `text`, `delete` and `restore` take an item `id`."""
+    op: Literal["create", "delete", "restore"]
+    id: int | None = None
+    text: str = ""
+
+
+class BatchRequest(BaseModel):
+    operations: list[BatchOperation] = Field(..., min_items=1, max_items=500)
+
+
+class BatchResult(BaseModel):
+    op: str
+    id: int | None = None
+    ok: bool
+    detail: str | None = None
+
+
+class Tombstone(BaseModel):
+    id: int
+    updated_time: int
+    deleted_at: int
+
+    class Config:
+        orm_mode = True
+
+
+class ItemChanges(BaseModel):
+    """Changes of one `/item/changes` page.
+
+    Pass `high_water_mark` as `since` on the next sync, or follow the
+    `X-Next-Cursor` header while there are more pages. With `resync` the
+    client missed purged deletions and has to fetch everything again.
+    """
+    items: list[Item]
+    deleted: list[Tombstone]
+    high_water_mark: int
+    resync: bool = False
@@ -0,0 +1,27 @@
+"""Fill the `search_terms` table with the text of existing items.
+
+Items written since search was added are indexed as they change.
+Postgres searches a GIN index instead, built by `src.migrate`. Run once
+after upgrading, from `server/`:
+
+    python -m src.search
+"""
+import asyncio
+
+from src import crud
+from src.database import AsyncSessionLocal, Base, engine
+
+
+async def rebuild():
+    async with AsyncSessionLocal() as db:
+        await crud.rebuild_search_index(db)
+
+
+def main():
+    Base.metadata.create_all(bind=engine)
+    asyncio.run(rebuild())
+    print("search index is up to date")
+
+
+if __name__ == "__main__":
+    main()
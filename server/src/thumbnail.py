@@ -0,0 +1,125 @@
+"""Resized variants of uploaded images.
+
+Variants are rendered in a process pool, so decoding large photos does
+not hold the GIL of the API worker, and cached on disk next to the
+original as `{name}.{size}.{ext}`.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from src.config import get_settings
+
+settings = get_settings()
+DATA_DIR = settings.data_dir
+THUMBNAIL_WORKERS = int(settings.thumbnail_workers)
+
+# Longest edge in pixels
+SIZES = {
+    "thumb": 256,
+    "medium": 1024,
+}
+# Formats kept as they are, anything else is converted to JPEG
+FORMATS = {
+    "JPEG": ("jpg", "image/jpeg"),
+    "PNG": ("png", "image/png"),
+    "WEBP": ("webp", "image/webp"),
+}
+
+logger = logging.getLogger(__name__)
+_executor: ProcessPoolExecutor | None = None
+_pending: dict[str, asyncio.Future] = {}
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Forking the worker, which runs threads, can copy a lock some
+        # thread holds into the child. `render` needs little to import.
+        _executor = ProcessPoolExecutor(
+            max_workers=THUMBNAIL_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"))
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def variant_name(name: str, size: str, ext: str) -> str:
+    return f"{os.path.splitext(name)[0]}.{size}.{ext}"
+
+
+def variant_names(name: str) -> list[str]:
+    """Every name a variant of `name` can be stored under."""
+    return [
+        variant_name(name, size, ext) for size in SIZES
+        for ext, _ in FORMATS.values()
+    ]
+
+
+def render(src: str, dst_stem: str, max_px: int) -> tuple[str, str]:
+    """Write a resized copy of `src`, return `(path, media type)`.
+
+    Runs in a worker process. The file is written under a temporary
+    name and renamed so readers never see a partial image.
+    """
+    with Image.open(src) as img:
+        fmt = img.format if img.format in FORMATS else "JPEG"
+        ext, media_type = FORMATS[fmt]
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_px, max_px))
+        if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        dst = f"{dst_stem}.{ext}"
+        tmp = f"{dst}.tmp{os.getpid()}"
+        img.save(tmp, format=fmt)
+    os.replace(tmp, dst)
+    return dst, media_type
+
+
+def find_variant(name: str, size: str) -> tuple[str, str] | None:
+    """Cached variant of `name` on disk, if there is one."""
+    for ext, media_type in FORMATS.values():
+        path = os.path.join(DATA_DIR, variant_name(name, size, ext))
+        if os.path.isfile(path):
+            return path, media_type
+    return None
+
+
+async def get_variant(name: str, size: str) -> tuple[str, str] | None:
+    """Path and media type of the `size` variant of stored file `name`.
+
+    Renders it on first use. Returns `None` if the file cannot be read
+    as an image, callers should serve the original instead.
+    """
+    cached = find_variant(name, size)
+    if cached is not None:
+        return cached
+    dst_stem = os.path.splitext(os.path.join(DATA_DIR, name))[0] + f".{size}"
+    future = _pending.get(dst_stem)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(get_executor(), render,
+                                      os.path.join(DATA_DIR, name), dst_stem,
+                                      SIZES[size])
+        _pending[dst_stem] = future
+        future.add_done_callback(lambda _: _pending.pop(dst_stem, None))
+    try:
+        return await asyncio.shield(future)
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        logger.warning("Cannot render %s variant of %s", size, name)
+        return None
+
+
+async def render_all(names: list[str]):
+    """Render every variant of freshly uploaded files."""
+    await asyncio.gather(
+        *[get_variant(name, size) for name in names for size in SIZES])
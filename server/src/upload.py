@@ -0,0 +1,278 @@
+"""Storing uploaded files in `DATA_DIR`.
+
+Files are stored once per content under
+`blobs/{sha[:2]}/{sha[2:4]}/{sha}.{ext}`. `receive_form` parses a
+multipart body as it arrives and writes file parts straight to disk,
+hashing and size checking each chunk. Each stored file holds a `Blob`
+reference until the request ends, so a concurrent delete of the same
+content never removes it.
+"""
+import hashlib
+import os
+import re
+import uuid
+from contextlib import asynccontextmanager
+
+import aiofiles  # type: ignore
+from fastapi import HTTPException, Request
+from multipart.exceptions import ParseError
+from multipart.multipart import (STATE_END, MultipartParser,
+                                 parse_options_header)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src import crud
+from src.config import get_settings
+
+settings = get_settings()
+DATA_DIR = settings.data_dir
+MAX_FILE_SIZE = int(settings.max_file_size)
+MAX_UPLOAD_SIZE = int(settings.max_upload_size)
+MAX_FIELD_SIZE = 1024 * 1024  # 1 MB
+_EXT = re.compile(r'[a-z0-9]{1,10}')
+
+
+def file_ext(filename: str) -> str:
+    """Lowercase extension of `filename`, `bin` unless it is short and
+    alphanumeric, as it becomes part of the stored path."""
+    _, dot, ext = filename.rpartition('.')
+    ext = ext.lower()
+    return ext if dot and _EXT.fullmatch(ext) else 'bin'
+
+
+class UploadBudget:
+    """Bytes left for the files of one request."""
+
+    def __init__(self, max_bytes: int):
+        self.remaining = max_bytes
+
+    def consume(self, n: int):
+        self.remaining -= n
+        if self.remaining < 0:
+            raise HTTPException(status_code=413,
+                                detail="Upload exceeds the request limit")
+
+
+class StoredFile:
+    """A file saved in `DATA_DIR` under its content-addressed `name`."""
+
+    def __init__(self, name: str, content_type: str):
+        self.name = name
+        self.content_type = content_type
+
+
+class BlobWriter:
+    """Stream one file to a temporary name in `DATA_DIR`, hashing and
+    size checking every chunk, then rename it to its blob path.
+
+    If the blob already exists the upload is dropped and the stored copy
+    is shared.
+    """
+
+    def __init__(self, filename: str, content_type: str, budget: UploadBudget):
+        self.filename = filename
+        self.content_type = content_type
+        self.ext = file_ext(filename)
+        self.budget = budget
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        tmp_dir = f"{DATA_DIR}/tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        self.tmp_path = f"{tmp_dir}/{uuid.uuid4().hex}"
+        self.file = None
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > MAX_FILE_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"{self.filename} exceeds the file limit")
+        self.budget.consume(len(chunk))
+        self.sha256.update(chunk)
+        if self.file is None:
+            self.file = await aiofiles.open(self.tmp_path, 'wb')
+        await self.file.write(chunk)
+
+    async def close(self, db: AsyncSession) -> StoredFile:
+        """Commit a reference to the blob, then store the file under it.
+
+        Deletes remove a file in the transaction that drops its last
+        reference, see `crud.remove_unused_files`. Taking the reference
+        first either keeps them from removing the blob, or waits until
+        it is gone and writes it again.
+        """
+        if self.file is None:
+            # Empty file
+            self.file = await aiofiles.open(self.tmp_path, 'wb')
+        await self.file.close()
+        digest = self.sha256.hexdigest()
+        name = f"blobs/{digest[:2]}/{digest[2:4]}/{digest}.{self.ext}"
+        await crud.acquire_blobs(db, [name])
+        await db.commit()
+        path = f"{DATA_DIR}/{name}"
+        if os.path.exists(path):
+            os.remove(self.tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.tmp_path, path)
+        return StoredFile(name, self.content_type)
+
+    async def abort(self):
+        if self.file is not None:
+            await self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+async def release_stored(db: AsyncSession, stored: list[StoredFile]):
+    """Drop the references `BlobWriter.close` took, removing the files
+    nothing else references."""
+    if not stored:
+        return
+    unused = await crud.release_blobs(db, [f.name for f in stored])
+    await crud.remove_unused_files(db, unused)
+    await db.commit()
+
+
+class StreamedForm:
+    """Fields and stored files of a parsed form."""
+
+    def __init__(self):
+        self.fields: dict[str, list[str]] = {}
+        self.files: dict[str, list[StoredFile]] = {}
+
+    def get(self, name: str, default: str = '') -> str:
+        values = self.fields.get(name)
+        return values[0] if values else default
+
+    def get_list(self, name: str) -> list[str]:
+        return self.fields.get(name, [])
+
+    def get_files(self, name: str) -> list[StoredFile]:
+        return self.files.get(name, [])
+
+    def stored(self) -> list[StoredFile]:
+        return [f for files in self.files.values() for f in files]
+
+
+class _Part:
+    """Headers and payload of the multipart part being parsed."""
+
+    def __init__(self):
+        self.headers: dict[bytes, bytes] = {}
+        self.header_field = b''
+        self.header_value = b''
+        self.name = ''
+        self.data = b''
+        self.writer: BlobWriter | None = None
+
+
+async def parse_multipart(request: Request, db: AsyncSession,
+                          form: StreamedForm):
+    """Parse a multipart body from the request stream into `form`.
+
+    File parts are written to `DATA_DIR` chunk by chunk as they arrive,
+    so an upload touches the disk once and is never held in memory.
+    A body without a boundary, malformed or cut off before its closing
+    boundary is rejected with 400.
+    """
+    _, params = parse_options_header(request.headers['content-type'])
+    if not params.get(b'boundary'):
+        raise HTTPException(status_code=400,
+                            detail="Missing multipart boundary")
+    charset = params.get(b'charset', b'utf-8').decode('latin-1')
+    budget = UploadBudget(MAX_UPLOAD_SIZE)
+    events: list[tuple[str, bytes]] = []
+
+    def on_data(kind):
+        return lambda data, start, end: events.append((kind, data[start:end]))
+
+    parser = MultipartParser(
+        params[b'boundary'], {
+            'on_part_begin': lambda: events.append(('begin', b'')),
+            'on_part_data': on_data('data'),
+            'on_part_end': lambda: events.append(('end', b'')),
+            'on_header_field': on_data('field'),
+            'on_header_value': on_data('value'),
+            'on_header_end': lambda: events.append(('header', b'')),
+            'on_headers_finished': lambda: events.append(('headers', b'')),
+        })
+    part = _Part()
+    try:
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except ParseError:
+                raise HTTPException(status_code=400,
+                                    detail="Malformed multipart body")
+            for kind, data in events:
+                if kind == 'begin':
+                    part = _Part()
+                elif kind == 'field':
+                    part.header_field += data
+                elif kind == 'value':
+                    part.header_value += data
+                elif kind == 'header':
+                    part.headers[part.header_field.lower()] = part.header_value
+                    part.header_field = part.header_value = b''
+                elif kind == 'headers':
+                    _, options = parse_options_header(
+                        part.headers.get(b'content-disposition', b''))
+                    part.name = options.get(b'name', b'').decode(charset)
+                    if b'filename' in options:
+                        part.writer = BlobWriter(
+                            options[b'filename'].decode(charset),
+                            part.headers.get(b'content-type',
+                                             b'').decode('latin-1'), budget)
+                elif kind == 'data':
+                    if part.writer is not None:
+                        await part.writer.write(data)
+                    else:
+                        part.data += data
+                        if len(part.data) > MAX_FIELD_SIZE:
+                            raise HTTPException(
+                                status_code=413,
+                                detail=f"Field {part.name} is too large")
+                elif kind == 'end':
+                    if part.writer is not None:
+                        stored_file = await part.writer.close(db)
+                        part.writer = None
+                        form.files.setdefault(part.name,
+                                              []).append(stored_file)
+                    else:
+                        form.fields.setdefault(part.name, []).append(
+                            part.data.decode(charset, errors='replace'))
+            events.clear()
+        parser.finalize()
+        if part.writer is not None or parser.state != STATE_END:
+            raise HTTPException(status_code=400,
+                                detail="Incomplete multipart body")
+    except BaseException:
+        if part.writer is not None:
+            await part.writer.abort()
+        raise
+
+
+@asynccontextmanager
+async def receive_form(request: Request, db: AsyncSession):
+    """Parse the request form and yield it as a `StreamedForm`.
+
+    Multipart bodies are streamed with `parse_multipart`, url-encoded
+    bodies carry no files and go through Starlette. The references of
+    the stored files are released when the block ends, after the block
+    committed images using them or rolled back, and files nothing
+    references any more are removed.
+    """
+    form = StreamedForm()
+    try:
+        content_type = request.headers.get('content-type', '')
+        if content_type.startswith('multipart/form-data'):
+            await parse_multipart(request, db, form)
+        else:
+            for key, value in (await request.form()).multi_items():
+                form.fields.setdefault(key, []).append(value)
+        yield form
+    except BaseException:
+        await db.rollback()
+        raise
+    finally:
+        await release_stored(db, form.stored())
@@ -0,0 +1,144 @@
+import asyncio
+import os
+
+import pytest
+import redis
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from benchmarks import configure
+
+# Run the in-process tests against a throwaway SQLite database unless
+# the environment already points somewhere else.
+configure(os.environ.get('DATABASE_URL'))
+
+from src import crud, schemas  # noqa: E402
+from src.database import AsyncSessionLocal, async_engine, get_redis  # noqa: E402
+from src.main import app  # noqa: E402
+from src.routers.auth import create_access_token  # noqa: E402
+
+TEST_IMAGE = os.path.join(os.path.dirname(__file__), 'test.jpg')
+
+
+@pytest.fixture(scope='session')
+def test_image() -> bytes:
+    """The 640x960 JPEG photo next to the tests."""
+    with open(TEST_IMAGE, 'rb') as f:
+        return f.read()
+
+
+def run(coro):
+    """Run a `crud` coroutine from a synchronous test."""
+    return asyncio.run(coro)
+
+
+@pytest.fixture()
+def db():
+    session = AsyncSessionLocal()
+    try:
+        yield session
+    finally:
+        run(session.close())
+
+
+@pytest.fixture(scope='session')
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture()
+def new_user(db):
+    """Create a fresh user and return `(user, auth headers)`."""
+    name = f'user_{os.urandom(6).hex()}'
+    user = run(
+        crud.create_user(
+            db, schemas.UserCreate(name=name, password='password12Caps@#$')))
+    token = create_access_token(data={'sub': user.name})
+    return user, {'Authorization': f'Bearer {token}'}
+
+
+class QueryCounter:
+    """Count statements executed by the app inside a `with` block."""
+
+    def __init__(self):
+        self.count = 0
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(async_engine.sync_engine, 'before_cursor_execute',
+                     self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(async_engine.sync_engine, 'before_cursor_execute',
+                     self._on_execute)
+
+
+@pytest.fixture()
+def count_queries():
+    return QueryCounter
+
+
+class FakeRedis:
+    """In-memory stand-in for the `redis.asyncio` calls the app makes.
+
+    Set `fail` to make every call raise, `script_results` are returned
+    by registered scripts in order.
+    """
+
+    def __init__(self):
+        self.data: dict[str, str] = {}
+        self.fail = False
+        self.script_results: list = []
+        self.script_calls: list = []
+
+    def _check(self):
+        if self.fail:
+            raise redis.ConnectionError('down')
+
+    async def get(self, key):
+        self._check()
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self._check()
+        self.data[key] = str(value)
+
+    async def delete(self, *keys):
+        self._check()
+        for key in keys:
+            self.data.pop(key, None)
+
+    async def incr(self, key):
+        self._check()
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+    def register_script(self, script):
+
+        async def call(keys, args, client):
+            client._check()
+            client.script_calls.append((keys, args))
+            return client.script_results.pop(0)
+
+        return call
+
+
+@pytest.fixture()
+def fake_redis():
+    return FakeRedis()
+
+
+@pytest.fixture()
+def with_redis(fake_redis):
+    """Serve requests with `fake_redis` as their Redis client."""
+
+    async def get_fake_redis():
+        yield fake_redis
+
+    app.dependency_overrides[get_redis] = get_fake_redis
+    yield fake_redis
+    app.dependency_overrides.pop(get_redis, None)
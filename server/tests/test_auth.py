@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from src import crud, hashing, ratelimit, schemas
+from src.main import app
+from src.routers.auth import RETRY_AFTER, create_access_token
+
+from tests.conftest import FakeRedis, run
+
+
+def test_register_and_login(client):
+    r = client.post('/api/v1/auth/register',
+                    json={
+                        'name': 'login_user',
+                        'password': 'password12Caps@#$'
+                    })
+    assert r.status_code == 200, r.text
+    r = client.post('/api/v1/auth/login',
+                    data={
+                        'username': 'login_user',
+                        'password': 'password12Caps@#$'
+                    })
+    assert r.status_code == 200, r.text
+    assert 'access_token' in r.json()
+    r = client.post('/api/v1/auth/login',
+                    data={
+                        'username': 'login_user',
+                        'password': 'wrongPassword12@#$'
+                    })
+    assert r.status_code == 401, r.text
+
+
+def test_login_busy(client, new_user, monkeypatch):
+    user, _ = new_user
+    monkeypatch.setattr(hashing.stats, 'pending',
+                        hashing.HASH_WORKERS + hashing.HASH_QUEUE_LIMIT)
+    r = client.post('/api/v1/auth/login',
+                    data={
+                        'username': user.name,
+                        'password': 'password12Caps@#$'
+                    })
+    assert r.status_code == 503, r.text
+    assert r.headers['Retry-After'] == str(RETRY_AFTER)
+
+
+def test_hash_queue_limit(monkeypatch):
+    monkeypatch.setattr(hashing, 'HASH_WORKERS', 1)
+    monkeypatch.setattr(hashing, 'HASH_QUEUE_LIMIT', 1)
+
+    async def burst():
+        return await asyncio.gather(
+            *[hashing.get_password_hash('secret') for _ in range(4)],
+            return_exceptions=True)
+
+    results = asyncio.run(burst())
+    assert sum(isinstance(r, hashing.HashQueueFull) for r in results) == 2
+    hashed = [r for r in results if isinstance(r, str)]
+    assert len(hashed) == 2
+    assert hashing.verify_password_sync('secret', hashed[0])
+    assert hashing.stats.calls >= 2
+
+
+def test_login_rate_limit(client, new_user, monkeypatch):
+    user, _ = new_user
+    limit = ratelimit.RateLimit('login', '2/60')
+    monkeypatch.setattr(ratelimit.login_limit, '_local', limit._local)
+    monkeypatch.setattr(ratelimit.login_limit, 'limit', 2)
+    form = {'username': user.name, 'password': 'wrongPassword12@#$'}
+    for _ in range(2):
+        r = client.post('/api/v1/auth/login', data=form)
+        assert r.status_code == 401, r.text
+    r = client.post('/api/v1/auth/login', data=form)
+    assert r.status_code == 429, r.text
+    assert 1 <= int(r.headers['Retry-After']) <= 60
+
+
+def test_upload_rate_limit_is_per_user(db, client, new_user, monkeypatch):
+    user, auth = new_user
+    other = run(
+        crud.create_user(
+            db,
+            schemas.UserCreate(name=f'{user.name}_2',
+                               password='password12Caps@#$')))
+    other_auth = {
+        'Authorization':
+        'Bearer ' + create_access_token(data={'sub': other.name})
+    }
+    limit = ratelimit.UserRateLimit('upload', '1/60')
+    monkeypatch.setattr(ratelimit.upload_limit, '_local', limit._local)
+    monkeypatch.setattr(ratelimit.upload_limit, 'limit', 1)
+    r = client.post('/api/v1/item/', headers=auth, data={'text': 'a'})
+    assert r.status_code == 200, r.text
+    r = client.post('/api/v1/item/', headers=auth, data={'text': 'b'})
+    assert r.status_code == 429, r.text
+    r = client.post('/api/v1/item/', headers=other_auth, data={'text': 'c'})
+    assert r.status_code == 200, r.text
+
+
+def test_sliding_window_frees_slots(monkeypatch):
+    limit = ratelimit.RateLimit('test', '2/10')
+    now = [100.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+    assert limit.retry_after_local('k') == 0
+    now[0] = 105
+    assert limit.retry_after_local('k') == 0
+    assert limit.retry_after_local('k') == 5
+    now[0] = 110.5
+    assert limit.retry_after_local('k') == 0
+    assert limit.retry_after_local('other') == 0
+
+
+def _behind_proxy(host):
+    """The app as uvicorn's proxy headers middleware presents it when
+    nginx forwards a request of `host`."""
+
+    async def asgi(scope, receive, send):
+        scope['client'] = (host, 50000)
+        await app(scope, receive, send)
+
+    return TestClient(asgi)
+
+
+def test_login_rate_limit_is_per_client(new_user, monkeypatch):
+    user, _ = new_user
+    limit = ratelimit.RateLimit('login', '1/60')
+    monkeypatch.setattr(ratelimit.login_limit, '_local', limit._local)
+    monkeypatch.setattr(ratelimit.login_limit, 'limit', 1)
+    form = {'username': user.name, 'password': 'wrongPassword12@#$'}
+    first, second = _behind_proxy('203.0.113.1'), _behind_proxy('203.0.113.2')
+    assert first.post('/api/v1/auth/login', data=form).status_code == 401
+    assert first.post('/api/v1/auth/login', data=form).status_code == 429
+    assert second.post('/api/v1/auth/login', data=form).status_code == 401
+
+
+def test_rate_limit_redis_script(monkeypatch):
+    limit = ratelimit.RateLimit('login', '2/60')
+    fake = FakeRedis()
+    fake.script_results = [0, 1500]
+    run(limit.check('203.0.113.1', fake))
+    keys, args = fake.script_calls[0]
+    assert keys == ['ratelimit:login:203.0.113.1']
+    assert args[:2] == [2, 60000]
+    with pytest.raises(HTTPException) as e:
+        run(limit.check('203.0.113.1', fake))
+    assert e.value.status_code == 429
+    assert e.value.headers['Retry-After'] == '2'
+    # Without Redis the local window takes over, only this request is in it
+    fake.fail = True
+    assert run(limit.retry_after('203.0.113.1', fake)) == 0
+    assert limit._local.get('203.0.113.1') is not None
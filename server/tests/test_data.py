@@ -0,0 +1,202 @@
+import hashlib
+import io
+import os
+
+from PIL import Image
+
+from sqlalchemy import delete
+
+from src import cache, crud, thumbnail, upload
+from src.database import AsyncSessionLocal, Image as DbImage
+from src.routers import data
+
+from tests.conftest import run
+
+
+def _upload(client, auth, name: str, content: bytes, content_type: str):
+    r = client.post('/api/v1/item/',
+                    headers=auth,
+                    data={'text': 'image'},
+                    files=[('images', (name, content, content_type))])
+    assert r.status_code == 200, r.text
+    return r.json()['images'][0]
+
+
+def test_thumbnail_variant(client, new_user, test_image):
+    _, auth = new_user
+    original = test_image
+    image = _upload(client, auth, 'test.jpg', original, 'image/jpeg')
+    assert image['thumbnail'].endswith('?size=thumb')
+
+    r = client.get(f"/data/{image['id']}")
+    assert r.status_code == 200, r.text
+    assert r.content == original
+
+    for size, max_px in thumbnail.SIZES.items():
+        r = client.get(f"/data/{image['id']}", params={'size': size})
+        assert r.status_code == 200, r.text
+        assert r.headers['content-type'] == 'image/jpeg'
+        with Image.open(io.BytesIO(r.content)) as img:
+            # never upscaled past the 640x960 original
+            assert max(img.size) == min(max_px, 960)
+
+
+def test_thumbnail_of_non_image_serves_original(client, new_user):
+    _, auth = new_user
+    image = _upload(client, auth, 'notes.txt', b'not an image', 'text/plain')
+    r = client.get(f"/data/{image['id']}", params={'size': 'thumb'})
+    assert r.status_code == 200, r.text
+    assert r.content == b'not an image'
+
+
+def test_unknown_size(client):
+    r = client.get('/data/1', params={'size': 'huge'})
+    assert r.status_code == 400, r.text
+
+
+def test_conditional_requests(client, new_user, count_queries, test_image):
+    _, auth = new_user
+    image = _upload(client, auth, 'test.jpg', test_image, 'image/jpeg')
+    r = client.get(f"/data/{image['id']}")
+    assert r.status_code == 200, r.text
+    assert 'immutable' in r.headers['cache-control']
+    etag = r.headers['etag']
+    assert not etag.startswith('W/')
+
+    thumb = client.get(f"/data/{image['id']}", params={'size': 'thumb'})
+    assert thumb.headers['etag'] != etag
+
+    with count_queries() as counter:
+        r = client.get(f"/data/{image['id']}", headers={'If-None-Match': etag})
+    assert r.status_code == 304, r.text
+    assert r.content == b''
+    assert counter.count == 0
+
+    r = client.get(f"/data/{image['id']}",
+                   headers={'If-None-Match': '"something-else"'})
+    assert r.status_code == 200, r.text
+
+    last_modified = r.headers['last-modified']
+    r = client.get(f"/data/{image['id']}",
+                   headers={'If-Modified-Since': last_modified})
+    assert r.status_code == 304, r.text
+    r = client.get(
+        f"/data/{image['id']}",
+        headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+    assert r.status_code == 200, r.text
+
+
+def test_image_deleted_by_another_worker(db, client, new_user):
+    """A cached image whose file is gone is a 404, not a broken send."""
+    _, auth = new_user
+    image = _upload(client, auth, 'a.jpg', os.urandom(256), 'image/jpeg')
+    url = f"/data/{image['id']}"
+    assert client.get(url).status_code == 200
+    assert cache.image_cache.get(image['id']) is not None
+    name = run(crud.get_image(db, image['id'])).data
+
+    # As the purge or another worker would, leaving this cache alone
+    async def purge():
+        await db.execute(delete(DbImage).where(DbImage.id == image['id']))
+        await db.commit()
+
+    run(purge())
+    os.remove(os.path.join(data.DATA_DIR, name))
+    r = client.get(url)
+    assert r.status_code == 404, r.text
+    assert cache.image_cache.get(image['id']) is None
+
+
+def test_nginx_file_serving(client, new_user, monkeypatch, test_image):
+    _, auth = new_user
+    image = _upload(client, auth, 'test.jpg', test_image, 'image/jpeg')
+    monkeypatch.setattr(data, 'FILE_SERVING', 'nginx')
+    r = client.get(f"/data/{image['id']}")
+    assert r.status_code == 200, r.text
+    assert r.content == b''
+    assert r.headers['content-type'] == 'image/jpeg'
+    redirect = r.headers['x-accel-redirect']
+    assert redirect.startswith(data.ACCEL_REDIRECT_PREFIX + '/')
+    assert os.path.isfile(
+        os.path.join(data.DATA_DIR,
+                     redirect[len(data.ACCEL_REDIRECT_PREFIX) + 1:]))
+    assert 'etag' in r.headers
+
+    r = client.get(f"/data/{image['id']}", params={'size': 'thumb'})
+    assert r.headers['x-accel-redirect'].endswith('.thumb.jpg')
+
+
+def test_uploads_are_deduplicated(db, client, new_user, test_image):
+    user, auth = new_user
+    # other tests upload the same photo
+    content = test_image + os.urandom(16)
+    first = _upload(client, auth, 'a.jpg', content, 'image/jpeg')
+    second = _upload(client, auth, 'b.jpg', content, 'image/jpeg')
+    images = [run(crud.get_image(db, img['id'])) for img in (first, second)]
+    name = images[0].data
+    assert name == images[1].data
+    assert name.startswith('blobs/')
+    assert hashlib.sha256(content).hexdigest() in name
+    path = os.path.join(data.DATA_DIR, name)
+
+    run(crud.delete_images_hard(db, images[0].item_id, [images[0].id]))
+    assert os.path.isfile(path)
+    run(crud.delete_images_hard(db, images[1].item_id, [images[1].id]))
+    assert not os.path.exists(path)
+    assert not os.path.exists(thumbnail.variant_name(path, 'thumb', 'jpg'))
+
+
+async def _store(db, name: str, content: bytes) -> upload.StoredFile:
+    writer = upload.BlobWriter(name, 'image/jpeg',
+                               upload.UploadBudget(len(content)))
+    await writer.write(content)
+    return await writer.close(db)
+
+
+def test_upload_holds_reused_blob(db, client, new_user):
+    """Files an upload is reusing survive deletes of the other users."""
+    user, auth = new_user
+    content = os.urandom(2048)
+    image = _upload(client, auth, 'a.jpg', content, 'image/jpeg')
+    db_image = run(crud.get_image(db, image['id']))
+    path = os.path.join(data.DATA_DIR, db_image.data)
+
+    async def reuse_while_deleting():
+        async with AsyncSessionLocal() as session:
+            stored = await _store(session, 'b.jpg', content)
+            assert stored.name == db_image.data
+            await crud.delete_images_hard(db, db_image.item_id, [db_image.id])
+            assert os.path.isfile(path)
+            await crud.create_user_item(session, user.id, 'reused',
+                                        [stored.name], ['image/jpeg'])
+            await upload.release_stored(session, [stored])
+
+    run(reuse_while_deleting())
+    assert os.path.isfile(path)
+
+    # Neither does a failed request remove a file another one reuses
+    content = os.urandom(2048)
+
+    async def fail_while_reusing():
+        async with AsyncSessionLocal() as first, \
+                AsyncSessionLocal() as second:
+            failed = await _store(first, 'c.jpg', content)
+            reused = await _store(second, 'd.jpg', content)
+            path = os.path.join(data.DATA_DIR, failed.name)
+            await upload.release_stored(first, [failed])
+            assert os.path.isfile(path)
+            await upload.release_stored(second, [reused])
+            assert not os.path.exists(path)
+
+    run(fail_while_reusing())
+
+
+def test_stored_extension_is_sanitized(db, client, new_user):
+    assert upload.file_ext('photo.JPG') == 'jpg'
+    for name in ('a.b/c', 'noext', 'x.../..', 'a.' + 'x' * 20, 'a.'):
+        assert upload.file_ext(name) == 'bin'
+    _, auth = new_user
+    image = _upload(client, auth, 'a.b/c', os.urandom(64), 'image/jpeg')
+    name = run(crud.get_image(db, image['id'])).data
+    assert name.startswith('blobs/') and name.endswith('.bin')
+    assert '..' not in name and name.count('/') == 3
@@ -0,0 +1,607 @@
+import asyncio
+import os
+import time
+
+import pytest
+from sqlalchemy import delete
+
+from src import cache, crud, schemas, upload
+from src.database import AsyncSessionLocal, SearchTerm
+from src.routers import item as item_router
+
+from tests.conftest import run
+
+
+def _create_items(db, user, n: int, images_per_item: int = 2):
+    for i in range(n):
+        paths = [f'{user.name}/{i}-{j}.jpg' for j in range(images_per_item)]
+        run(
+            crud.create_user_item(db, user.id, f'item {i}', paths,
+                                  ['image/jpeg'] * images_per_item))
+
+
+def test_list_query_count_is_constant(db, client, new_user, count_queries):
+    user, auth = new_user
+    _create_items(db, user, 1)
+    client.get('/api/v1/user/me', headers=auth)  # warm the user cache
+    with count_queries() as one:
+        r = client.get('/api/v1/item/list', headers=auth)
+    assert r.status_code == 200, r.text
+    assert len(r.json()) == 1
+
+    _create_items(db, user, 9)
+    with count_queries() as ten:
+        r = client.get('/api/v1/item/list', headers=auth)
+    assert r.status_code == 200, r.text
+    assert len(r.json()) == 10
+    assert all(len(item['images']) == 2 for item in r.json())
+    assert ten.count == one.count
+    # items + images, the user comes from the cache
+    assert ten.count <= 2
+
+
+def test_list_skips_deleted_images(db, client, new_user):
+    user, auth = new_user
+    item = run(
+        crud.create_user_item(db, user.id, 'text', ['a.jpg', 'b.jpg'],
+                              ['image/jpeg'] * 2))
+    run(
+        crud.update_user_item(db, user.id, item.id, 'text',
+                              [item.images[0].id], [], []))
+    r = client.get('/api/v1/item/list', headers=auth)
+    assert r.status_code == 200, r.text
+    assert [img['id'] for img in r.json()[0]['images']] == [item.images[1].id]
+
+
+def test_recycle_query_count_is_constant(db, client, new_user, count_queries):
+    user, auth = new_user
+    _create_items(db, user, 10)
+    for item in run(crud.get_user_items(db, user.id)):
+        run(crud.delete_user_item(db, item.id, user.id))
+    with count_queries() as counter:
+        r = client.get('/api/v1/item/recycle', headers=auth)
+    assert r.status_code == 200, r.text
+    assert len(r.json()) == 10
+    assert all(len(item['images']) == 2 for item in r.json())
+    assert counter.count <= 3
+
+
+def test_list_cursor_pagination(db, client, new_user):
+    user, auth = new_user
+    _create_items(db, user, 25, images_per_item=0)
+    ids = []
+    cursor = None
+    for _ in range(3):
+        params = {'cursor': cursor} if cursor else {}
+        r = client.get('/api/v1/item/list', headers=auth, params=params)
+        assert r.status_code == 200, r.text
+        ids += [item['id'] for item in r.json()]
+        cursor = r.headers.get('X-Next-Cursor')
+    assert cursor is None
+    assert len(ids) == len(set(ids)) == 25
+
+    r = client.get('/api/v1/item/list', headers=auth, params={'offset': 10})
+    assert [item['id'] for item in r.json()] == ids[10:20]
+
+
+def test_list_invalid_cursor(client, new_user):
+    _, auth = new_user
+    r = client.get('/api/v1/item/list',
+                   headers=auth,
+                   params={'cursor': 'not-a-cursor'})
+    assert r.status_code == 400, r.text
+
+
+def test_item_lifecycle(client, new_user, test_image):
+    _, auth = new_user
+    r = client.post('/api/v1/item/',
+                    headers=auth,
+                    data={'text': 'hello'},
+                    files=[('images', ('test.jpg', test_image, 'image/jpeg'))])
+    assert r.status_code == 200, r.text
+    item = r.json()
+    assert len(item['images']) == 1
+
+    r = client.get('/api/v1/item/', headers=auth, params={'id': item['id']})
+    assert r.status_code == 200, r.text
+    assert r.json()['text'] == 'hello'
+
+    r = client.put(f"/api/v1/item/{item['id']}",
+                   headers=auth,
+                   data={'text': 'edited'})
+    assert r.status_code == 200, r.text
+    assert r.json()['text'] == 'edited'
+
+    r = client.delete(f"/api/v1/item/{item['id']}", headers=auth)
+    assert r.status_code == 200, r.text
+    r = client.get('/api/v1/item/recycle', headers=auth)
+    assert [i['id'] for i in r.json()] == [item['id']]
+
+    r = client.post(f"/api/v1/item/restore/{item['id']}", headers=auth)
+    assert r.status_code == 200, r.text
+    r = client.get('/api/v1/user/me', headers=auth)
+    assert r.json()['total_items'] == 1
+    assert r.json()['total_images'] == 1
+
+
+def test_statistics_exact_under_parallel_writers(db, client, new_user):
+    user, auth = new_user
+    n = 20
+
+    async def writer(i):
+        async with AsyncSessionLocal() as session:
+            item = await crud.create_user_item(session, user.id, f'{i}',
+                                               ['a.jpg', 'b.jpg'],
+                                               ['image/jpeg'] * 2)
+            if i % 2:
+                await crud.delete_user_item(session, item.id, user.id)
+
+    async def writers():
+        await asyncio.gather(*[writer(i) for i in range(n)])
+
+    run(writers())
+    r = client.get('/api/v1/user/me', headers=auth)
+    assert r.json()['total_items'] == n // 2
+    assert r.json()['total_images'] == n
+
+
+def test_read_item_not_found_vs_not_yours(db, client, new_user):
+    user, auth = new_user
+    item = run(crud.create_user_item(db, user.id, 'mine', [], []))
+    other = run(crud.create_user_item(db, user.id + 100000, 'x', [], []))
+    r = client.get('/api/v1/item/', headers=auth, params={'id': item.id})
+    assert r.status_code == 200, r.text
+    r = client.get('/api/v1/item/', headers=auth, params={'id': other.id})
+    assert r.status_code == 400, r.text
+    r = client.get('/api/v1/item/', headers=auth, params={'id': 10**9})
+    assert r.status_code == 404, r.text
+
+
+def test_delete_query_count(db, client, new_user, count_queries):
+    user, auth = new_user
+    item = run(
+        crud.create_user_item(db, user.id, 'text', ['a.jpg', 'b.jpg'],
+                              ['image/jpeg'] * 2))
+    client.get('/api/v1/user/me', headers=auth)  # warm the user cache
+    with count_queries() as counter:
+        r = client.delete(f'/api/v1/item/{item.id}', headers=auth)
+    assert r.status_code == 200, r.text
+    # item, images, item update, images update, statistics update
+    assert counter.count <= 5
+
+
+def _stored_files():
+    return {
+        os.path.join(root, name)
+        for root, _, names in os.walk(upload.DATA_DIR) for name in names
+    }
+
+
+def test_upload_many_files(client, new_user):
+    _, auth = new_user
+    files = [('images', (f'{i}.jpg', os.urandom(1024), 'image/jpeg'))
+             for i in range(9)]
+    r = client.post('/api/v1/item/', headers=auth, files=files)
+    assert r.status_code == 200, r.text
+    assert len(r.json()['images']) == 9
+
+
+def test_upload_too_large_leaves_no_files(client, new_user, monkeypatch):
+    _, auth = new_user
+    monkeypatch.setattr(upload, 'MAX_FILE_SIZE', 1000)
+    before = _stored_files()
+    files = [('images', ('small.jpg', os.urandom(500), 'image/jpeg')),
+             ('images', ('large.jpg', os.urandom(5000), 'image/jpeg'))]
+    r = client.post('/api/v1/item/', headers=auth, files=files)
+    assert r.status_code == 413, r.text
+    assert _stored_files() == before
+
+    monkeypatch.setattr(upload, 'MAX_FILE_SIZE', 10000)
+    monkeypatch.setattr(upload, 'MAX_UPLOAD_SIZE', 6000)
+    files.append(('images', ('more.jpg', os.urandom(5000), 'image/jpeg')))
+    r = client.post('/api/v1/item/', headers=auth, files=files)
+    assert r.status_code == 413, r.text
+    assert _stored_files() == before
+
+
+def test_failed_insert_leaves_no_files(client, new_user, monkeypatch):
+    _, auth = new_user
+
+    async def fail(*args):
+        raise RuntimeError('database is down')
+
+    monkeypatch.setattr(crud, 'create_user_item', fail)
+    before = _stored_files()
+    files = [('images', ('a.jpg', os.urandom(500), 'image/jpeg'))]
+    with pytest.raises(RuntimeError):
+        client.post('/api/v1/item/', headers=auth, files=files)
+    assert _stored_files() == before
+
+
+def test_edit_item_multipart(client, new_user):
+    _, auth = new_user
+    files = [('images', (f'{i}.png', os.urandom(256), 'image/png'))
+             for i in range(2)]
+    r = client.post('/api/v1/item/',
+                    headers=auth,
+                    data={'text': 'before'},
+                    files=files)
+    assert r.status_code == 200, r.text
+    item = r.json()
+    assert item['text'] == 'before'
+    removed = item['images'][0]['id']
+    r = client.put(f'/api/v1/item/{item["id"]}',
+                   headers=auth,
+                   data={
+                       'text': 'after',
+                       'delete': [removed]
+                   },
+                   files=[('add', ('new.png', os.urandom(256), 'image/png'))])
+    assert r.status_code == 200, r.text
+    edited = r.json()
+    assert edited['text'] == 'after'
+    live = [img['id'] for img in edited['images'] if not img['deleted_at']]
+    assert removed not in live and len(live) == 2
+
+
+def test_parse_multipart_small_chunks(db):
+    """Parts split across arbitrary chunk boundaries are reassembled."""
+    from starlette.requests import Request
+
+    boundary = 'xYzZy'
+    content = os.urandom(3000)
+    body = (f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="text"\r\n\r\n'
+            'hello\r\n'
+            f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="images"; '
+            'filename="a.jpg"\r\n'
+            'Content-Type: image/jpeg\r\n\r\n').encode() + content + (
+                f'\r\n--{boundary}--\r\n').encode()
+    chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {
+            'type': 'http.request',
+            'body': chunk,
+            'more_body': bool(chunks)
+        }
+
+    content_type = f'multipart/form-data; boundary={boundary}'.encode()
+    scope = {'type': 'http', 'headers': [(b'content-type', content_type)]}
+    request = Request(scope, receive)
+    form = upload.StreamedForm()
+    run(upload.parse_multipart(request, db, form))
+    assert form.get('text') == 'hello'
+    [stored] = form.get_files('images')
+    assert stored.content_type == 'image/jpeg'
+    with open(f'{upload.DATA_DIR}/{stored.name}', 'rb') as f:
+        assert f.read() == content
+
+
+def _post_raw(client, auth, content_type, body):
+    headers = dict(auth, **{'Content-Type': content_type})
+    return client.post('/api/v1/item/', headers=headers, data=body)
+
+
+def test_bad_multipart_is_rejected(client, new_user):
+    _, auth = new_user
+    before = _stored_files()
+    r = _post_raw(client, auth, 'multipart/form-data', b'text=a')
+    assert r.status_code == 400, r.text
+    r = _post_raw(client, auth, 'multipart/form-data; boundary=xYzZy',
+                  b'garbage\r\n\r\n--not the boundary')
+    assert r.status_code == 400, r.text
+    assert _stored_files() == before
+
+
+def test_truncated_multipart_is_rejected(client, new_user):
+    _, auth = new_user
+    before = _stored_files()
+    boundary = 'xYzZy'
+    body = (f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="text"\r\n\r\n'
+            'cut off\r\n'
+            f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="images"; '
+            'filename="a.jpg"\r\n'
+            'Content-Type: image/jpeg\r\n\r\n').encode() + os.urandom(3000)
+    r = _post_raw(client, auth, f'multipart/form-data; boundary={boundary}',
+                  body)
+    assert r.status_code == 400, r.text
+    # Neither the item nor the partial file, in blobs or tmp, is kept
+    assert _stored_files() == before
+    r = client.get('/api/v1/item/list', headers=auth)
+    assert r.json() == []
+
+
+def _search(client, auth, q, cursor=None):
+    params = {'q': q} if cursor is None else {'q': q, 'cursor': cursor}
+    r = client.get('/api/v1/item/search', headers=auth, params=params)
+    assert r.status_code == 200, r.text
+    return [item['text'] for item in r.json()], r.headers.get('X-Next-Cursor')
+
+
+def test_search_ranked_and_synced(db, client, new_user):
+    user, auth = new_user
+    for text in ['apple pie', 'Apple apple tart', 'banana bread', 'pie']:
+        run(crud.create_user_item(db, user.id, text, [], []))
+    run(crud.create_user_item(db, 1, 'apple of someone else', [], []))
+
+    assert _search(client, auth,
+                   'apple')[0] == ['Apple apple tart', 'apple pie']
+    assert _search(client, auth, 'APPLE pie!')[0] == ['apple pie']
+    assert _search(client, auth, 'cherry')[0] == []
+
+    tart = run(crud.search_items(db, user.id, 'tart'))[0]
+    run(crud.update_user_item(db, user.id, tart.id, 'cherry tart', [], [], []))
+    assert _search(client, auth, 'cherry')[0] == ['cherry tart']
+    assert _search(client, auth, 'apple')[0] == ['apple pie']
+
+    run(crud.delete_user_item(db, tart.id, user.id))
+    assert _search(client, auth, 'cherry')[0] == []
+    run(crud.restore_item(db, tart.id, user.id))
+    assert _search(client, auth, 'cherry')[0] == ['cherry tart']
+
+
+def test_search_cursor_pagination(db, client, new_user):
+    user, auth = new_user
+    for i in range(item_router.PAGE_SIZE + 3):
+        run(crud.create_user_item(db, user.id, 'memo ' * (i + 1), [], []))
+    first, cursor = _search(client, auth, 'memo')
+    assert len(first) == item_router.PAGE_SIZE and cursor
+    second, cursor = _search(client, auth, 'memo', cursor)
+    assert len(second) == 3 and cursor is None
+    counts = [text.count('memo') for text in first + second]
+    assert counts == sorted(counts, reverse=True)
+
+
+def test_search_rebuild_index(db, client, new_user):
+    user, auth = new_user
+    run(crud.create_user_item(db, user.id, 'indexed later', [], []))
+    run(db.execute(delete(SearchTerm)))
+    run(db.commit())
+    assert _search(client, auth, 'later')[0] == []
+    run(crud.rebuild_search_index(db))
+    assert _search(client, auth, 'later')[0] == ['indexed later']
+
+
+def test_list_page_cache(db, client, new_user, count_queries):
+    user, auth = new_user
+    _create_items(db, user, 2)
+    first = client.get('/api/v1/item/list', headers=auth)
+    hits = cache.list_stats.hits
+    with count_queries() as counter:
+        r = client.get('/api/v1/item/list', headers=auth)
+    assert counter.count == 0
+    assert cache.list_stats.hits == hits + 1
+    assert r.json() == first.json()
+    assert r.headers.get('X-Next-Cursor') is None
+
+    item_id = first.json()[0]['id']
+    assert client.delete(f'/api/v1/item/{item_id}',
+                         headers=auth).status_code == 200
+    r = client.get('/api/v1/item/list', headers=auth)
+    assert [item['id'] for item in r.json()] == [first.json()[1]['id']]
+    client.post(f'/api/v1/item/restore/{item_id}', headers=auth)
+    r = client.get('/api/v1/item/list', headers=auth)
+    assert [item['id']
+            for item in r.json()] == [item['id'] for item in first.json()]
+
+
+def test_list_page_cache_redis(db, client, new_user, with_redis,
+                               count_queries):
+    user, auth = new_user
+    _create_items(db, user, 2)
+    first = client.get('/api/v1/item/list', headers=auth)
+    assert first.status_code == 200, first.text
+    pages = [k for k in with_redis.data if k.startswith('items:page:')]
+    assert pages and all(
+        k.startswith(f'items:page:{user.id}:r0:') for k in pages)
+    with count_queries() as counter:
+        r = client.get('/api/v1/item/list', headers=auth)
+    assert counter.count == 0
+    assert r.json() == first.json()
+
+    item_id = first.json()[0]['id']
+    assert client.delete(f'/api/v1/item/{item_id}',
+                         headers=auth).status_code == 200
+    assert with_redis.data[f'items:version:{user.id}'] == '1'
+    r = client.get('/api/v1/item/list', headers=auth)
+    assert [item['id'] for item in r.json()] == [first.json()[1]['id']]
+
+    # With Redis down the in-memory versions and pages take over
+    with_redis.fail = True
+    assert run(cache.get_list_version(user.id, with_redis)).startswith('l')
+    r = client.get('/api/v1/item/list', headers=auth)
+    assert r.status_code == 200, r.text
+    assert [item['id'] for item in r.json()] == [first.json()[1]['id']]
+
+    # Changes made meanwhile bump the Redis version once it is back, the
+    # page it cached before the outage is not served
+    assert client.delete(f"/api/v1/item/{first.json()[1]['id']}",
+                         headers=auth).status_code == 200
+    with_redis.fail = False
+    r = client.get('/api/v1/item/list', headers=auth)
+    assert r.json() == []
+    assert with_redis.data[f'items:version:{user.id}'] == '2'
+    assert not cache.missed_bumps
+
+
+def test_list_page_cache_several_workers(db, client, new_user, monkeypatch,
+                                         count_queries):
+    """Workers can't invalidate each other's memory, only Redis caches."""
+    user, auth = new_user
+    _create_items(db, user, 1)
+    monkeypatch.setattr(cache, 'LOCAL_LIST_CACHE', False)
+    client.get('/api/v1/item/list', headers=auth)
+    with count_queries() as counter:
+        r = client.get('/api/v1/item/list', headers=auth)
+    assert r.status_code == 200, r.text
+    assert counter.count > 0
+
+
+def test_batch_operations(db, client, new_user, count_queries):
+    user, auth = new_user
+    _create_items(db, user, 3)
+    items = client.get('/api/v1/item/list', headers=auth).json()
+    ids = [item['id'] for item in items]
+    other = run(crud.create_user_item(db, 1, 'not yours', [], []))
+    r = client.post('/api/v1/item/batch',
+                    headers=auth,
+                    json={
+                        'operations': [
+                            {
+                                'op': 'delete',
+                                'id': ids[0]
+                            },
+                            {
+                                'op': 'delete',
+                                'id': ids[1]
+                            },
+                            {
+                                'op': 'create',
+                                'text': 'batch memo'
+                            },
+                            {
+                                'op': 'delete',
+                                'id': other.id
+                            },
+                            {
+                                'op': 'restore',
+                                'id': ids[2]
+                            },
+                            {
+                                'op': 'restore',
+                                'id': ids[0]
+                            },
+                        ]
+                    })
+    assert r.status_code == 200, r.text
+    results = r.json()
+    assert [res['ok']
+            for res in results] == [True, True, True, False, False, False]
+    assert results[2]['id'] is not None
+    assert results[3]['detail'] == 'Item not found'
+    assert results[5]['detail'] == 'Item already in this batch'
+
+    listed = [
+        item['id']
+        for item in client.get('/api/v1/item/list', headers=auth).json()
+    ]
+    assert listed == [results[2]['id'], ids[2]]
+    me = client.get('/api/v1/user/me', headers=auth).json()
+    assert (me['total_items'], me['total_images']) == (2, 2)
+    assert run(crud.get_item(db, other.id)).deleted_at is None
+
+    operations = [{'op': 'restore', 'id': i} for i in ids[:2]]
+    with count_queries() as counter:
+        r = client.post('/api/v1/item/batch',
+                        headers=auth,
+                        json={'operations': operations})
+    assert all(res['ok'] for res in r.json())
+    # lookup, images update, items update, statistics update
+    assert counter.count <= 4
+    item = run(crud.get_item(db, ids[0]))
+    assert item.deleted_at is None
+    assert all(img.deleted_at is None for img in item.images)
+    me = client.get('/api/v1/user/me', headers=auth).json()
+    assert (me['total_items'], me['total_images']) == (4, 6)
+
+
+def test_batch_limits(client, new_user):
+    _, auth = new_user
+    r = client.post('/api/v1/item/batch',
+                    headers=auth,
+                    json={'operations': []})
+    assert r.status_code == 422
+    r = client.post('/api/v1/item/batch',
+                    headers=auth,
+                    json={'operations': [{
+                        'op': 'create'
+                    }] * 501})
+    assert r.status_code == 422
+
+
+def _changes(client, auth, since, cursor=None):
+    params = {'since': since}
+    if cursor is not None:
+        params['cursor'] = cursor
+    r = client.get('/api/v1/item/changes', headers=auth, params=params)
+    assert r.status_code == 200, r.text
+    return r.json(), r.headers.get('X-Next-Cursor')
+
+
+def test_changes_since(db, client, new_user, monkeypatch):
+    monkeypatch.setattr(item_router, 'SYNC_LAG_MS', 0)
+    user, auth = new_user
+    _create_items(db, user, 3)
+    changes, cursor = _changes(client, auth, 0)
+    assert cursor is None and changes['deleted'] == []
+    assert len(changes['items']) == 3
+    ids = [item['id'] for item in changes['items']]
+    mark = changes['high_water_mark']
+
+    changes, _ = _changes(client, auth, mark)
+    assert changes['items'] == [] and changes['high_water_mark'] >= mark
+
+    time.sleep(0.002)
+    run(crud.delete_user_item(db, ids[0], user.id))
+    run(crud.update_user_item(db, user.id, ids[1], 'edited', [], [], []))
+    changes, _ = _changes(client, auth, mark)
+    assert [item['text'] for item in changes['items']] == ['edited']
+    assert [t['id'] for t in changes['deleted']] == [ids[0]]
+    mark = changes['high_water_mark']
+
+    time.sleep(0.002)
+    run(crud.restore_item(db, ids[0], user.id))
+    changes, _ = _changes(client, auth, mark)
+    assert [item['id'] for item in changes['items']] == [ids[0]]
+    assert len(changes['items'][0]['images']) == 2
+    assert changes['deleted'] == []
+
+
+def test_changes_pagination_with_shared_timestamp(db, client, new_user,
+                                                  monkeypatch):
+    monkeypatch.setattr(item_router, 'SYNC_LAG_MS', 0)
+    monkeypatch.setattr(item_router, 'CHANGES_PAGE_SIZE', 4)
+    _, auth = new_user
+    r = client.post('/api/v1/item/batch',
+                    headers=auth,
+                    json={'operations': [{
+                        'op': 'create'
+                    }] * 6})
+    created = [res['id'] for res in r.json()]
+    first, cursor = _changes(client, auth, 0)
+    assert len(first['items']) == 4 and cursor
+    second, cursor = _changes(client, auth, 0, cursor)
+    assert cursor is None
+    assert [item['id'] for item in first['items'] + second['items']] == created
+    # Resuming from the mark of a partial page repeats, never skips
+    resumed, _ = _changes(client, auth, first['high_water_mark'])
+    assert len(resumed['items']) >= 2
+
+
+def test_changes_resync_after_retention(client, new_user):
+    _, auth = new_user
+    changes, _ = _changes(client, auth, 1)
+    assert changes['resync']
+    changes, _ = _changes(client, auth, 0)
+    assert not changes['resync']
+
+
+def test_fast_serializer_matches_schema(db, client, new_user):
+    user, auth = new_user
+    _create_items(db, user, 1)
+    item = run(crud.get_user_items(db, user.id))[0]
+    run(crud.delete_user_item(db, item.id, user.id))
+    r = client.get('/api/v1/item/', headers=auth, params={'id': item.id})
+    assert r.status_code == 200, r.text
+    item = run(crud.get_item(db, item.id))
+    item.images = item_router.parse_images(item.images)
+    expected = schemas.Item.from_orm(item).dict()
+    assert r.json() == expected
+    assert item_router.item_dict(item) == expected
+    r = client.get('/api/v1/item/recycle', headers=auth)
+    assert r.json() == [expected]
@@ -0,0 +1,85 @@
+import os
+import re
+
+from src import metrics
+
+
+def _sample(text, name, **labels):
+    selector = ','.join(f'{k}="{v}"' for k, v in labels.items())
+    if selector:
+        name = f'{name}{{{selector}}}'
+    match = re.search(rf'^{re.escape(name)} (\S+)$', text, re.MULTILINE)
+    return float(match.group(1)) if match else 0
+
+
+def test_metrics_endpoint(client, new_user):
+    _, auth = new_user
+    before = client.get('/metrics').text
+    for _ in range(3):
+        assert client.get('/api/v1/item/list', headers=auth).status_code == 200
+    assert client.get('/data/123456789').status_code == 404
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    assert r.headers['content-type'].startswith('text/plain')
+    text = r.text
+
+    route = '/api/v1/item/list'
+    ok = dict(method='GET', route=route, status='200')
+    assert _sample(text, 'memo_requests_total', **ok) - _sample(
+        before, 'memo_requests_total', **ok) == 3
+    # Routes are labelled by path template, not by the requested path
+    missing = dict(method='GET', route='/data/{image_id}', status='404')
+    assert _sample(text, 'memo_requests_total', **missing) >= 1
+    count = dict(method='GET', route=route)
+    assert _sample(text, 'memo_request_duration_seconds_count', **count) - \
+        _sample(before, 'memo_request_duration_seconds_count', **count) == 3
+    assert _sample(text, 'memo_db_queries_sum', **count) > _sample(
+        before, 'memo_db_queries_sum', **count)
+    assert _sample(text, 'memo_db_duration_seconds_sum', **count) > 0
+    inf = dict(method='GET', route=route, le='+Inf')
+    assert _sample(text, 'memo_response_size_bytes_bucket', **inf) == \
+        _sample(text, 'memo_response_size_bytes_count', **count)
+    # The scrape itself is in flight
+    assert _sample(text, 'memo_requests_in_flight') == 1
+
+
+def test_route_labels(client):
+    """Labels come from the route the router picked."""
+    before = client.get('/metrics').text
+    assert client.get('/openapi.json').status_code == 200
+    assert client.get('/no/such/page').status_code == 404
+    assert client.post('/metrics').status_code == 405
+    text = client.get('/metrics').text
+    for labels in (dict(method='GET', route='/openapi.json', status='200'),
+                   dict(method='GET', route='<unmatched>', status='404'),
+                   dict(method='POST', route='/metrics', status='405')):
+        assert _sample(text, 'memo_requests_total', **labels) - _sample(
+            before, 'memo_requests_total', **labels) == 1
+
+
+def test_merge_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, 'INTERVAL', 5)
+    registry = metrics.Registry()
+    stats = metrics.RequestStats()
+    stats.queries = 2
+    registry.record('GET', '/a', 200, 0.02, 500, stats)
+    monkeypatch.setattr(metrics, 'registry', registry)
+
+    other = metrics.Registry()
+    other.record('GET', '/a', 200, 3, 50, metrics.RequestStats())
+    other.in_flight = 4
+    (tmp_path / f'{os.getppid()}.json').write_text(
+        metrics.json.dumps(other.snapshot()))
+    # Not a live process, so not counted
+    (tmp_path / f'{2**22 + 1}.json').write_text(
+        metrics.json.dumps(other.snapshot()))
+
+    text = metrics.exposition()
+    labels = dict(method='GET', route='/a')
+    assert _sample(text, 'memo_requests_total', **labels, status='200') == 2
+    bucket = 'memo_request_duration_seconds_bucket'
+    assert _sample(text, bucket, **labels, le='0.025') == 1
+    assert _sample(text, bucket, **labels, le='5') == 2
+    assert _sample(text, 'memo_db_queries_sum', **labels) == 2
+    assert _sample(text, 'memo_requests_in_flight') == 4
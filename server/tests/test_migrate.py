@@ -0,0 +1,47 @@
+from sqlalchemy import create_engine, inspect, insert, select
+
+from src import migrate
+from src.database import Base, User, UserStatistics
+
+
+def _indexes(engine, table):
+    return {i['name'] for i in inspect(engine).get_indexes(table)}
+
+
+def _declared_indexes(table):
+    return {i.name for i in Base.metadata.tables[table].indexes}
+
+
+def test_upgrade(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/migrate.db')
+    with engine.begin() as conn:
+        migrate.create_released_tables(conn)
+    assert not _indexes(engine, 'items')
+    with engine.begin() as conn:
+        conn.execute(insert(User).values(id=1, name='a'))
+        conn.execute(insert(UserStatistics),
+                     [dict(user_id=1, total_items=5, total_images=5)] * 2)
+
+    assert migrate.upgrade(engine) == [1]
+    # The released tables end up with every index the model declares
+    for table in migrate.RELEASED_TABLES:
+        assert _indexes(engine, table) == _declared_indexes(table)
+    assert 'ix_items_owner_updated' in _indexes(engine, 'items')
+    unique = inspect(engine).get_indexes('user_statistics')[0]
+    assert unique['name'] == 'ix_user_statistics_user_id'
+    assert unique['unique']
+    with engine.connect() as conn:
+        stats = conn.execute(select(UserStatistics)).all()
+        assert migrate.current_version(conn) == 1
+    # The duplicate is gone and the kept row recounted
+    assert [(s.id, s.total_items) for s in stats] == [(1, 0)]
+
+    assert migrate.upgrade(engine) == []
+
+
+def test_upgrade_fresh_database(tmp_path):
+    # Tables made by `create_all` already have the indexes
+    engine = create_engine(f'sqlite:///{tmp_path}/fresh.db')
+    Base.metadata.create_all(bind=engine)
+    assert migrate.upgrade(engine) == [1]
+    assert 'ix_items_live' in _indexes(engine, 'items')
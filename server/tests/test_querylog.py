@@ -0,0 +1,87 @@
+import logging
+
+from sqlalchemy import event, select
+
+from src import metrics, querylog
+from src.database import Item, async_engine
+
+from tests.conftest import run
+
+
+class _Listening:
+    """Attach the querylog events for one test."""
+
+    def __enter__(self):
+        event.listen(async_engine.sync_engine, 'before_cursor_execute',
+                     querylog._before_cursor_execute)
+        event.listen(async_engine.sync_engine, 'after_cursor_execute',
+                     querylog._after_cursor_execute)
+
+    def __exit__(self, *exc):
+        event.remove(async_engine.sync_engine, 'before_cursor_execute',
+                     querylog._before_cursor_execute)
+        event.remove(async_engine.sync_engine, 'after_cursor_execute',
+                     querylog._after_cursor_execute)
+
+
+def _select_items(db, ids, route='/test'):
+
+    async def go():
+        token = metrics._current.set(metrics.RequestStats(route))
+        try:
+            for i in ids:
+                await db.execute(select(Item).where(Item.id == i))
+        finally:
+            metrics._current.reset(token)
+
+    run(go())
+
+
+def test_shape():
+    assert querylog.shape('SELECT a FROM t WHERE id IN (?, ?, ?)') == \
+        querylog.shape('SELECT a FROM t WHERE id IN (?)')
+    assert querylog.shape('x IN ($1, $2) AND y = $3') == \
+        'x IN (...) AND y = $3'
+
+
+def test_slow_query_log(db, monkeypatch, caplog):
+    monkeypatch.setattr(querylog, 'SLOW_QUERY_MS', 1e-6)
+    monkeypatch.setattr(querylog, 'EXPLAIN', True)
+    monkeypatch.setattr(querylog, 'DETECT_N_PLUS_ONE', False)
+    with _Listening(), caplog.at_level(logging.WARNING, 'src.querylog'):
+        _select_items(db, [424242], route='/api/v1/item/')
+    slow = [r.getMessage() for r in caplog.records]
+    assert len(slow) == 1
+    assert 'Slow query' in slow[0]
+    assert 'on /api/v1/item/' in slow[0]
+    # Bound values are left out unless asked for
+    assert 'params: (int)' in slow[0]
+    assert '424242' not in slow[0]
+    # SQLite's plan of a primary key lookup
+    assert 'USING INTEGER PRIMARY KEY' in slow[0]
+
+    caplog.clear()
+    monkeypatch.setattr(querylog, 'LOG_PARAMS', True)
+    with _Listening(), caplog.at_level(logging.WARNING, 'src.querylog'):
+        _select_items(db, [424242])
+    assert '424242' in caplog.records[0].getMessage()
+
+
+def test_describe_params():
+    assert querylog.describe({'name': 'x', 'n': 1}) == '(name: str, n: int)'
+    assert querylog.describe([(1, b'x'), (2, b'y')],
+                             True) == '2 x (int, bytes)'
+    assert querylog.describe(tuple(range(30))).endswith('int, ...)')
+
+
+def test_n_plus_one(db, monkeypatch, caplog):
+    monkeypatch.setattr(querylog, 'SLOW_QUERY_MS', 0)
+    monkeypatch.setattr(querylog, 'DETECT_N_PLUS_ONE', True)
+    monkeypatch.setattr(querylog, 'N_PLUS_ONE_THRESHOLD', 3)
+    with _Listening(), caplog.at_level(logging.WARNING, 'src.querylog'):
+        _select_items(db, range(3))
+        assert not caplog.records
+        _select_items(db, range(10))
+    warnings = [r.getMessage() for r in caplog.records]
+    assert len(warnings) == 1
+    assert 'Possible N+1 on /test: statement ran 4 times' in warnings[0]
@@ -0,0 +1,88 @@
+import io
+import json
+import zipfile
+
+from src import cache, crud, schemas
+
+from tests.conftest import run
+
+
+def test_current_user_is_cached(client, new_user, count_queries):
+    user, auth = new_user
+    r = client.get('/api/v1/user/me', headers=auth)
+    assert r.status_code == 200, r.text
+    with count_queries() as counter:
+        r = client.get('/api/v1/user/me', headers=auth)
+    assert r.status_code == 200, r.text
+    assert r.json()['name'] == user.name
+    # `get_me` only, no user lookup for authentication
+    assert counter.count == 2
+
+
+def test_password_change_invalidates_cache(db, client, new_user):
+    user, auth = new_user
+    client.get('/api/v1/user/me', headers=auth)
+    assert cache.user_cache.get(user.name) is not None
+    run(crud.update_user_password(db, user.id, 'newPassword12@#$'))
+    assert cache.user_cache.get(user.name) is None
+
+
+def test_user_cache_redis_tier(fake_redis):
+    user = schemas.CurrentUser(id=1, name='redis_user', created_time=1)
+    run(cache.set_cached_user(user, fake_redis))
+    assert 'user:redis_user' in fake_redis.data
+    # Another worker finds it in Redis and keeps it in memory
+    cache.user_cache.delete(user.name)
+    assert run(cache.get_cached_user(user.name, fake_redis)) == user
+    assert cache.user_cache.get(user.name) == user
+
+    run(cache.invalidate_user(user.name, fake_redis))
+    assert fake_redis.data == {}
+    assert run(cache.get_cached_user(user.name, fake_redis)) is None
+
+    # Redis errors are cache misses
+    fake_redis.fail = True
+    run(cache.set_cached_user(user, fake_redis))
+    assert cache.user_cache.get(user.name) == user
+    cache.user_cache.delete(user.name)
+    assert run(cache.get_cached_user(user.name, fake_redis)) is None
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    c = cache.TTLCache(maxsize=2, ttl=60)
+    c.set('a', 1)
+    c.set('b', 2)
+    c.get('a')
+    c.set('c', 3)
+    assert c.get('a') == 1
+    assert c.get('b') is None
+    assert c.get('c') == 3
+
+
+def test_ttl_cache_expires():
+    c = cache.TTLCache(maxsize=2, ttl=-1)
+    c.set('a', 1)
+    assert c.get('a') is None
+
+
+def test_export_streams_zip(client, new_user, test_image):
+    user, auth = new_user
+    image = test_image
+    for text in ['first', 'second']:
+        r = client.post('/api/v1/item/',
+                        headers=auth,
+                        data={'text': text},
+                        files=[('images', ('test.jpg', image, 'image/jpeg'))])
+        assert r.status_code == 200, r.text
+
+    r = client.get('/api/v1/user/export', headers=auth)
+    assert r.status_code == 200, r.text
+    assert r.headers['content-type'] == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(r.content)) as zip_file:
+        names = zip_file.namelist()
+        lines = zip_file.read(f'{user.name}/{user.name}.ndjson').splitlines()
+        items = [json.loads(line) for line in lines]
+        assert [item['text'] for item in items] == ['first', 'second']
+        for item in items:
+            assert item['images'][0] in names
+            assert zip_file.read(item['images'][0]) == image